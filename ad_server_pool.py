@@ -0,0 +1,132 @@
+# ad_server_pool.py - Domain controller pool with latency-aware ordering and failover
+import time
+import random
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from ldap3 import Server, ServerPool, ALL, FIRST
+
+
+logger = logging.getLogger(__name__)
+
+
+# Passes the pool makes over every server looking for a live one before giving up
+POOL_ACTIVE_CYCLES = 1
+
+# Schemes accepted in AD_SERVER entries, with whether they use SSL and their default port
+LDAP_SCHEMES = {'ldap': (False, 389), 'ldaps': (True, 636)}
+
+# (host, port, use_ssl) -> (probe time, latency in seconds or None if unreachable)
+_probe_cache: Dict[Tuple[str, int, bool], Tuple[float, Optional[float]]] = {}
+_probe_lock = threading.Lock()
+
+
+def parse_server_list(servers, default_port: int, default_ssl: bool = False) -> List[Tuple[str, int, bool]]:
+	"""Parse AD_SERVER entries of the form host, host:port, ldap://host[:port] or ldaps://host[:port].
+
+	A scheme sets SSL for that server. Without an explicit port, AD_PORT is used
+	when the scheme agrees with AD_USE_SSL, otherwise the scheme's default port.
+	"""
+	if isinstance(servers, str):
+		servers = servers.split(',')
+
+	parsed = []
+	for entry in servers:
+		entry = entry.strip()
+		if not entry:
+			continue
+
+		use_ssl = default_ssl
+		port = default_port
+		address = entry
+		if '://' in entry:
+			scheme, address = entry.split('://', 1)
+			if scheme.lower() not in LDAP_SCHEMES:
+				raise ValueError(f"Invalid AD_SERVER entry '{entry}': scheme must be ldap:// or ldaps://")
+			use_ssl, scheme_port = LDAP_SCHEMES[scheme.lower()]
+			if use_ssl != default_ssl:
+				port = scheme_port
+			address = address.rstrip('/')
+
+		host = address
+		if address.count(':') == 1:
+			host, port_text = address.split(':')
+			if not port_text.isdigit():
+				raise ValueError(f"Invalid AD_SERVER entry '{entry}': port must be a number")
+			port = int(port_text)
+		if not host or '/' in host:
+			raise ValueError(f"Invalid AD_SERVER entry '{entry}'")
+
+		parsed.append((host, port, use_ssl))
+	return parsed
+
+
+def probe_latency(host: str, port: int, timeout: float) -> Optional[float]:
+	"""Measure the TCP connect time to a domain controller, or None if it is unreachable"""
+	started = time.monotonic()
+	try:
+		with socket.create_connection((host, port), timeout=timeout):
+			return time.monotonic() - started
+	except OSError as e:
+		logger.warning(f"AD server {host}:{port} unreachable: {e}")
+		return None
+
+
+def probe_servers(servers: List[Tuple[str, int, bool]], timeout: float, max_age: float) -> Dict[Tuple[str, int, bool], Optional[float]]:
+	"""Probe all servers in parallel, reusing results younger than max_age seconds"""
+	now = time.monotonic()
+	with _probe_lock:
+		latencies = {server: cached[1] for server, cached in _probe_cache.items()
+					 if server in servers and now - cached[0] < max_age}
+
+	stale = [server for server in servers if server not in latencies]
+	if stale:
+		with ThreadPoolExecutor(max_workers=len(stale)) as executor:
+			results = executor.map(lambda server: probe_latency(server[0], server[1], timeout), stale)
+			fresh = dict(zip(stale, results))
+
+		with _probe_lock:
+			for server, latency in fresh.items():
+				_probe_cache[server] = (now, latency)
+		latencies.update(fresh)
+
+	return latencies
+
+
+def order_by_latency(latencies: Dict[Tuple[str, int, bool], Optional[float]]) -> List[Tuple[str, int, bool]]:
+	"""Order reachable servers by a latency-weighted random draw, unreachable ones last.
+
+	Faster DCs are picked first more often, but every healthy DC gets a share
+	of connections so bulk runs spread across them.
+	"""
+	reachable = [(server, latency) for server, latency in latencies.items() if latency is not None]
+	unreachable = [server for server, latency in latencies.items() if latency is None]
+
+	# Weighted random permutation: sort by u ** (1 / weight) with weight = 1 / latency
+	keyed = [(random.random() ** max(latency, 1e-6), server) for server, latency in reachable]
+	keyed.sort(reverse=True)
+	return [server for _, server in keyed] + unreachable
+
+
+def build_server_pool(config) -> ServerPool:
+	"""Build an ldap3 ServerPool over the configured domain controllers"""
+	servers = parse_server_list(config.AD_SERVER, config.AD_PORT, config.AD_USE_SSL)
+	if not servers:
+		raise ValueError("AD_SERVER is not configured")
+
+	if len(servers) > 1:
+		latencies = probe_servers(servers, config.AD_PROBE_TIMEOUT, config.AD_PROBE_CACHE_SECONDS)
+		servers = order_by_latency(latencies)
+		logger.debug(f"AD server order: {servers} (latencies: {latencies})")
+
+	# FIRST keeps our latency order; active probes each server before use and
+	# exhaust takes failed servers out of rotation for a while
+	return ServerPool(
+		[Server(host, port=port, get_info=ALL, use_ssl=use_ssl,
+				connect_timeout=config.AD_CONNECT_TIMEOUT) for host, port, use_ssl in servers],
+		FIRST,
+		active=POOL_ACTIVE_CYCLES,
+		exhaust=config.AD_POOL_EXHAUST_SECONDS
+	)
@@ -1,13 +1,19 @@
 # app.py - Full M365 Support with Azure OAuth
 import os
+import asyncio
 import logging
 import urllib.parse
 import uuid
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import json
+from datetime import datetime, timezone
+from flask import Flask, Response, render_template, request, jsonify, session, redirect, url_for, stream_with_context
 from flask_session import Session
 import msal
 from config import Config
-from user_deprovisioning_service import UserDeprovisioningService
+from user_deprovisioning_service import UserDeprovisioningService, ad_actions_needed, summarize_reclaimed_skus
+from deprovisioning_journal import DeprovisioningJournal
+from stale_account_sweep import iter_stale_accounts
+from deprovisioning_scheduler import DeprovisioningScheduler, JOB_STATUSES, parse_run_at
 
 
 # Configure logging
@@ -22,6 +28,12 @@ app = Flask(__name__)
 app.config.from_object(Config)
 Session(app)
 
+# Every worker (and the debug reloader's parent) runs a scheduler; jobs are claimed under a
+# renewed lease, so each runs once and only jobs of a dead worker are requeued
+scheduler = DeprovisioningScheduler() if Config.SCHEDULER_ENABLED else None
+if scheduler:
+	scheduler.start()
+
 
 def _load_cache():
 	"""Load token cache from session"""
@@ -70,14 +82,6 @@ def index():
 @app.route('/login')
 def login():
 	"""Initiate login process"""
-	# Microsoft Graph scopes needed
-	scopes = [
-		"User.ReadWrite.All",
-		"Directory.ReadWrite.All",
-		"UserAuthenticationMethod.ReadWrite.All",
-		"Group.ReadWrite.All"
-	]
-	
 	# Generate state and save to session
 	state = str(uuid.uuid4())
 	session["flow"] = {
@@ -113,12 +117,7 @@ def auth_response():
 		# Get token using authorization code
 		result = auth_app.acquire_token_by_authorization_code(
 			request.args['code'],
-			scopes=[
-				"User.ReadWrite.All",
-				"Directory.ReadWrite.All",
-				"UserAuthenticationMethod.ReadWrite.All",
-				"Group.ReadWrite.All"
-			],
+			scopes=Config.GRAPH_SCOPES,
 			redirect_uri=url_for("auth_response", _external=True)
 		)
    	 
@@ -217,6 +216,7 @@ def deprovision_user():
 		actions = data.get('actions', {})
 		ad_username = data.get('adUsername', '').strip()
 		ad_password = data.get('adPassword', '').strip()
+		run_id = data.get('runId', '').strip()
    	 
 		if not user_email:
 			return jsonify({'error': 'User email is required'}), 400
@@ -235,101 +235,33 @@ def deprovision_user():
 		service.graph_client = session.get("access_token")
 		service.add_result("Auth", "success", f"Authenticated as: {current_user.get('name', 'Unknown User')}")
    	 
-		# Connect to AD if needed
-		ad_needed = any([
-			actions.get('adActions', False),
-			actions.get('orgActions', False)
-		])
+		# Open the run journal so a failed run can be resumed where it stopped
+		try:
+			service.journal = DeprovisioningJournal.open_run(run_id)
+		except ValueError:
+			return jsonify({'error': 'Invalid run ID'}), 400
    	 
-		if ad_needed:
+		# Connect to AD if needed
+		if ad_actions_needed(actions):
 			if not service.connect_ad_with_credentials(ad_username, ad_password):
 				return jsonify({
 					'results': service.results,
-					'password': None
+					'password': None,
+					'runId': service.journal.run_id
 				}), 200
    	 
-		# User lookup phase
-		ad_user = None
-		graph_user = None
-   	 
-		if ad_needed:
-			ad_user = service.find_ad_user(user_email)
-	   	 
-		# Look up M365 user if M365 actions are needed
-		m365_needed = any([
-			actions.get('m365Actions', False),
-			actions.get('mfaActions', False)
-		])
-   	 
-		if m365_needed:
-			graph_user = service.find_graph_user(user_email)
-   	 
-		if not ad_user and not graph_user:
-			service.add_result("User Search", "error", "User not found in any connected system")
-			return jsonify({'results': service.results, 'password': None}), 200
-   	 
-		# Password generation
-		exclude_names = []
-		if graph_user:
-			exclude_names.extend([
-				graph_user.get('givenName', ''),
-				graph_user.get('surname', '')
-			])
-		elif ad_user:
-			exclude_names.extend([
-				str(getattr(ad_user, 'givenName', '')),
-				str(getattr(ad_user, 'sn', ''))
-			])
-   	 
-		password = service.generate_password(exclude_names=exclude_names)
-		service.add_result("Password", "success", "Secure password generated (excluding user names)")
-   	 
-		# Execute Active Directory actions
-		if actions.get('adActions') and ad_user:
-			user_dn = str(ad_user.distinguishedName)
-	   	 
-			if actions.get('disableAD'):
-				service.disable_ad_account(user_dn)
-		   	 
-			if actions.get('expireAD'):
-				service.set_ad_expiration(user_dn)
-		   	 
-			if actions.get('resetADPassword'):
-				service.reset_ad_password(user_dn, password)
-   	 
-		# Execute Microsoft 365 actions (now with real Graph API calls)
-		if actions.get('m365Actions') and graph_user:
-			user_id = graph_user['id']
-	   	 
-			if actions.get('disableM365'):
-				service.disable_m365_account(user_id)
-		   	 
-			if actions.get('revokeSessions'):
-				service.revoke_m365_sessions(user_id)
-   	 
-		# Execute MFA cleanup (now with real Graph API calls)
-		if actions.get('mfaActions') and graph_user:
-			user_id = graph_user['id']
-	   	 
-			if actions.get('removeMFA'):
-				service.remove_mfa_methods(user_id)
-   	 
-		# Execute organizational actions
-		if actions.get('orgActions'):
-			if actions.get('moveToTerminated') and ad_user:
-				service.move_ad_user(str(ad_user.distinguishedName))
+		password = service.deprovision_user(user_email, actions)
    	 
 		# Cleanup connections
 		if service.ad_connection:
 			service.ad_connection.unbind()
    	 
-		service.add_result("Complete", "success", "User deprovisioning process completed successfully!")
-   	 
 		logger.info(f"Deprovisioning completed for {user_email} by {current_user.get('preferred_username')}. Total actions: {len(service.results)}")
    	 
 		return jsonify({
 			'results': service.results,
-			'password': password
+			'password': password,
+			'runId': service.journal.run_id
 		}), 200
    	 
 	except Exception as e:
@@ -337,6 +269,198 @@ def deprovision_user():
 		return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 
+@app.route('/deprovision-bulk', methods=['POST'])
+def deprovision_bulk():
+	"""Deprovision many users concurrently with the asyncio service"""
+	if not session.get("user"):
+		return jsonify({'error': 'Not authenticated to Microsoft 365'}), 401
+	
+	try:
+		# httpx is only needed for bulk runs
+		from async_deprovisioning_service import deprovision_many
+   	 
+		data = request.get_json()
+		user_emails = [email.strip() for email in data.get('userEmails', []) if email.strip()]
+		actions = data.get('actions', {})
+		ad_username = data.get('adUsername', '').strip()
+		ad_password = data.get('adPassword', '').strip()
+		run_id = data.get('runId', '').strip()
+   	 
+		if not user_emails:
+			return jsonify({'error': 'At least one user email is required'}), 400
+	   	 
+		if not ad_username or not ad_password:
+			return jsonify({'error': 'AD credentials are required'}), 400
+   	 
+		current_user = session.get("user", {})
+		logger.info(f"User {current_user.get('preferred_username', 'unknown')} starting bulk deprovisioning for {len(user_emails)} users")
+   	 
+		# The connection service only holds run-level results; each user gets their own
+		service = UserDeprovisioningService()
+		service.add_result("Auth", "success", f"Authenticated as: {current_user.get('name', 'Unknown User')}")
+   	 
+		try:
+			journal = DeprovisioningJournal.open_run(run_id)
+		except ValueError:
+			return jsonify({'error': 'Invalid run ID'}), 400
+   	 
+		if ad_actions_needed(actions):
+			if not service.connect_ad_with_credentials(ad_username, ad_password):
+				return jsonify({'results': service.results, 'users': {}, 'runId': journal.run_id}), 200
+   	 
+		users = asyncio.run(deprovision_many(
+			user_emails,
+			actions,
+			session.get("access_token"),
+			ad_connection=service.ad_connection,
+			journal=journal
+		))
+   	 
+		if service.ad_connection:
+			service.ad_connection.unbind()
+   	 
+		logger.info(f"Bulk deprovisioning of {len(user_emails)} users completed by {current_user.get('preferred_username')}")
+   	 
+		return jsonify({
+			'results': service.results,
+			'users': users,
+			'licenseSummary': summarize_reclaimed_skus(
+				result for outcome in users.values() for result in outcome['results']
+			),
+			'runId': journal.run_id
+		}), 200
+   	 
+	except Exception as e:
+		logger.exception("Bulk deprovisioning error")
+		return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+@app.route('/sweep', methods=['POST'])
+def sweep_stale_accounts():
+	"""Stream stale AD accounts as NDJSON, one candidate per line"""
+	if not session.get("user"):
+		return jsonify({'error': 'Not authenticated to Microsoft 365'}), 401
+	
+	try:
+		data = request.get_json()
+		ad_username = data.get('adUsername', '').strip()
+		ad_password = data.get('adPassword', '').strip()
+		inactive_days = int(data.get('inactiveDays') or Config.STALE_INACTIVE_DAYS)
+		password_age_days = int(data['passwordAgeDays']) if data.get('passwordAgeDays') else None
+   	 
+		if not ad_username or not ad_password:
+			return jsonify({'error': 'AD credentials are required'}), 400
+   	 
+		service = UserDeprovisioningService()
+		if not service.connect_ad_with_credentials(ad_username, ad_password):
+			return jsonify({'results': service.results}), 200
+   	 
+		logger.info(f"User {session.get('user', {}).get('preferred_username', 'unknown')} started a stale account sweep ({inactive_days} days)")
+   	 
+		def generate():
+			try:
+				for candidate in iter_stale_accounts(service.ad_connection, inactive_days, password_age_days):
+					yield json.dumps(candidate) + '\n'
+			finally:
+				service.ad_connection.unbind()
+   	 
+		return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+   	 
+	except ValueError:
+		return jsonify({'error': 'inactiveDays and passwordAgeDays must be numbers'}), 400
+	except Exception as e:
+		logger.exception("Stale account sweep error")
+		return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+@app.route('/schedule', methods=['GET'])
+def list_scheduled_jobs():
+	"""List scheduled jobs, optionally filtered by status"""
+	if not session.get("user"):
+		return jsonify({'error': 'Not authenticated to Microsoft 365'}), 401
+	if not scheduler:
+		return jsonify({'error': 'Scheduling is disabled'}), 503
+	
+	status = request.args.get('status')
+	if status and status not in JOB_STATUSES:
+		return jsonify({'error': f'Status must be one of: {", ".join(JOB_STATUSES)}'}), 400
+   	 
+	limit = min(request.args.get('limit', 100, type=int), 1000)
+	offset = request.args.get('offset', 0, type=int)
+	return jsonify({'jobs': scheduler.store.list(status, limit, offset)}), 200
+
+
+@app.route('/schedule', methods=['POST'])
+def schedule_deprovisioning():
+	"""Schedule users for deprovisioning at a given time or in the next off-peak window"""
+	if not session.get("user"):
+		return jsonify({'error': 'Not authenticated to Microsoft 365'}), 401
+	if not scheduler:
+		return jsonify({'error': 'Scheduling is disabled'}), 503
+	
+	try:
+		data = request.get_json()
+		user_emails = [email.strip() for email in data.get('userEmails', []) if email.strip()]
+		actions = data.get('actions', {})
+		off_peak = bool(data.get('offPeak'))
+   	 
+		if not user_emails:
+			return jsonify({'error': 'At least one user email is required'}), 400
+   	 
+		if not any(actions.values()):
+			return jsonify({'error': 'At least one action must be selected'}), 400
+   	 
+		try:
+			run_at = parse_run_at(data['runAt']) if data.get('runAt') else datetime.now(timezone.utc).timestamp()
+		except ValueError:
+			return jsonify({'error': 'runAt must be an ISO 8601 date and time'}), 400
+   	 
+		created_by = session.get("user", {}).get("preferred_username", "unknown")
+		jobs = scheduler.schedule(user_emails, actions, run_at, off_peak=off_peak, created_by=created_by)
+		logger.info(f"User {created_by} scheduled deprovisioning for {len(jobs)} users at {jobs[0]['runAt']}")
+   	 
+		return jsonify({'jobs': jobs}), 201
+   	 
+	except Exception as e:
+		logger.exception("Scheduling error")
+		return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+
+@app.route('/schedule/<job_id>', methods=['DELETE'])
+def cancel_scheduled_job(job_id):
+	"""Cancel a job that has not started yet"""
+	if not session.get("user"):
+		return jsonify({'error': 'Not authenticated to Microsoft 365'}), 401
+	if not scheduler:
+		return jsonify({'error': 'Scheduling is disabled'}), 503
+	
+	if not scheduler.cancel(job_id):
+		return jsonify({'error': 'Job not found or already started'}), 409
+   	 
+	logger.info(f"User {session.get('user', {}).get('preferred_username', 'unknown')} cancelled scheduled job {job_id}")
+	return jsonify({'job': scheduler.store.get(job_id)}), 200
+
+
+@app.route('/schedule/<job_id>/reschedule', methods=['POST'])
+def reschedule_job(job_id):
+	"""Move a job that has not started yet to a new time"""
+	if not session.get("user"):
+		return jsonify({'error': 'Not authenticated to Microsoft 365'}), 401
+	if not scheduler:
+		return jsonify({'error': 'Scheduling is disabled'}), 503
+	
+	data = request.get_json()
+	try:
+		run_at = parse_run_at(data['runAt'])
+	except (KeyError, TypeError, ValueError):
+		return jsonify({'error': 'runAt must be an ISO 8601 date and time'}), 400
+   	 
+	if not scheduler.reschedule(job_id, run_at, off_peak=bool(data.get('offPeak'))):
+		return jsonify({'error': 'Job not found or already started'}), 409
+   	 
+	return jsonify({'job': scheduler.store.get(job_id)}), 200
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
 	"""Health check endpoint"""
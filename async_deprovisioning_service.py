@@ -0,0 +1,536 @@
+# async_deprovisioning_service.py - asyncio variant of the deprovisioning service
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+import logging
+from typing import Dict, List, Optional
+import httpx
+from config import Config
+from user_deprovisioning_service import (
+	UserDeprovisioningService, GRAPH_USER_SELECT, GRAPH_LICENSE_SELECT, ad_actions_needed, m365_actions_needed,
+	split_license_assignments
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+GRAPH_BASE_URL = 'https://graph.microsoft.com/v1.0'
+
+# Status codes Graph uses for throttling and transient failures
+RETRYABLE_STATUS_CODES = {429, 503, 504}
+
+GRAPH_BATCH_SIZE = 20  # maximum sub-requests per $batch call
+
+
+class AsyncGraphClient:
+	"""Pooled Microsoft Graph client shared by every user in an async run"""
+
+	def __init__(self, access_token: str, max_connections: Optional[int] = None, max_retries: int = 3):
+		max_connections = max_connections or Config.GRAPH_MAX_CONNECTIONS
+		self.max_retries = max_retries
+		self._sku_part_numbers = None
+		self._client = httpx.AsyncClient(
+			base_url=GRAPH_BASE_URL,
+			headers={
+				'Authorization': f'Bearer {access_token}',
+				'Content-Type': 'application/json'
+			},
+			limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+			timeout=30.0
+		)
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc, tb):
+		await self.aclose()
+
+	async def aclose(self):
+		await self._client.aclose()
+
+	async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+		"""Send a request, backing off on throttling responses as Graph asks via Retry-After"""
+		for attempt in range(self.max_retries + 1):
+			response = await self._client.request(method, url, **kwargs)
+			if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+				return response
+
+			delay = float(response.headers.get('Retry-After', 2 ** attempt))
+			logger.warning(f"Graph returned {response.status_code} for {method} {url}, retrying in {delay}s")
+			await asyncio.sleep(delay)
+
+	async def get(self, url: str, **kwargs) -> httpx.Response:
+		return await self.request('GET', url, **kwargs)
+
+	async def post(self, url: str, **kwargs) -> httpx.Response:
+		return await self.request('POST', url, **kwargs)
+
+	async def patch(self, url: str, **kwargs) -> httpx.Response:
+		return await self.request('PATCH', url, **kwargs)
+
+	async def delete(self, url: str, **kwargs) -> httpx.Response:
+		return await self.request('DELETE', url, **kwargs)
+
+	async def batch(self, requests: List[Dict]) -> Dict[str, Dict]:
+		"""Send sub-requests through $batch, GRAPH_BATCH_SIZE at a time, returning responses by id.
+
+		Throttled sub-requests are resent together after the longest Retry-After
+		any of them asked for.
+		"""
+		responses = {}
+		pending = list(requests)
+
+		for attempt in range(self.max_retries + 1):
+			chunks = [pending[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(pending), GRAPH_BATCH_SIZE)]
+			batch_responses = await asyncio.gather(*(self.post('/$batch', json={'requests': chunk}) for chunk in chunks))
+
+			requests_by_id = {sub_request['id']: sub_request for sub_request in pending}
+			throttled = []
+			delay = 0.0
+			for chunk, batch_response in zip(chunks, batch_responses):
+				if batch_response.status_code != 200:
+					for sub_request in chunk:
+						responses[sub_request['id']] = {'id': sub_request['id'], 'status': batch_response.status_code,
+														'body': batch_response.text}
+					continue
+
+				for sub_response in batch_response.json().get('responses', []):
+					if sub_response['status'] in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+						throttled.append(requests_by_id[sub_response['id']])
+						retry_after = (sub_response.get('headers') or {}).get('Retry-After', 2 ** attempt)
+						delay = max(delay, float(retry_after))
+					else:
+						responses[sub_response['id']] = sub_response
+
+			if not throttled:
+				break
+			logger.warning(f"Graph throttled {len(throttled)} batched requests, retrying in {delay}s")
+			await asyncio.sleep(delay)
+			pending = throttled
+
+		return responses
+
+	async def get_sku_part_numbers(self) -> Dict[str, str]:
+		"""Map the tenant's subscribed SKU ids to their part numbers, fetched once per client"""
+		if self._sku_part_numbers is None:
+			self._sku_part_numbers = {}
+			try:
+				response = await self.get('/subscribedSkus', params={'$select': 'skuId,skuPartNumber'})
+				if response.status_code == 200:
+					self._sku_part_numbers = {sku['skuId']: sku['skuPartNumber']
+											  for sku in response.json().get('value', [])}
+			except Exception as e:
+				logger.warning(f"Could not resolve SKU names: {e}")
+		return self._sku_part_numbers
+
+
+class AsyncJournalWriter:
+	"""Single writer task that group-commits journal records off the event loop.
+
+	Steps await their record before moving on, so the journal stays as
+	durable as the synchronous service, but records queued while a write is
+	in flight share the next write and fsync, in the default executor.
+	"""
+
+	def __init__(self, journal):
+		self.journal = journal
+		self._queue = asyncio.Queue()
+		self._task = None
+
+	async def __aenter__(self):
+		self._task = asyncio.create_task(self._run())
+		return self
+
+	async def __aexit__(self, exc_type, exc, tb):
+		await self._queue.put(None)
+		await self._task
+
+	async def record(self, user: str, step: str, target_id: str, outcome: str):
+		future = asyncio.get_running_loop().create_future()
+		await self._queue.put(((user, step, target_id, outcome), future))
+		await future
+
+	async def _run(self):
+		loop = asyncio.get_running_loop()
+		stopping = False
+		while not stopping:
+			batch = [await self._queue.get()]
+			while not self._queue.empty():
+				batch.append(self._queue.get_nowait())
+			if None in batch:
+				stopping = True
+				batch = [item for item in batch if item is not None]
+			if not batch:
+				continue
+
+			try:
+				await loop.run_in_executor(None, self.journal.record_many, [record for record, _ in batch])
+			except Exception as e:
+				for _, future in batch:
+					future.set_exception(e)
+			else:
+				for _, future in batch:
+					future.set_result(None)
+
+
+class AsyncUserDeprovisioningService(UserDeprovisioningService):
+	"""Deprovisioning service whose actions are coroutines.
+
+	Graph calls go through a shared AsyncGraphClient. ldap3 is blocking, so AD
+	operations run in the default executor, serialized by ad_lock because a
+	single ldap3 connection must not be used from two threads at once.
+	"""
+
+	def __init__(self, graph: Optional[AsyncGraphClient], ad_lock: Optional[asyncio.Lock] = None):
+		super().__init__()
+		self.graph = graph
+		self.ad_lock = ad_lock or asyncio.Lock()
+		self.graph_user = None
+		self.journal_writer = None
+
+	async def _run_ad(self, action, *args):
+		"""Run a blocking AD operation without blocking the event loop"""
+		async with self.ad_lock:
+			loop = asyncio.get_running_loop()
+			return await loop.run_in_executor(None, functools.partial(action, *args))
+
+	async def run_step(self, user_email: str, step: str, target_id: str, action, *args) -> bool:
+		"""Run a deprovisioning step, skipping it if the run journal shows it already completed"""
+		if self.journal and self.journal.is_completed(user_email, step):
+			self.add_result("Resume", "info", f"Skipping {step}: already completed in a previous attempt")
+			return True
+
+		success = await action(*args)
+		await self.record_step(user_email, step, target_id, success)
+		return success
+
+	async def record_step(self, user_email: str, step: str, target_id: str, success: bool):
+		"""Journal a step without blocking the event loop on the fsync"""
+		outcome = 'success' if success else 'error'
+		if self.journal_writer:
+			await self.journal_writer.record(user_email, step, target_id, outcome)
+		elif self.journal:
+			loop = asyncio.get_running_loop()
+			await loop.run_in_executor(None, self.journal.record, user_email, step, target_id, outcome)
+
+	async def deprovision_user(self, user_email: str, actions: Dict, finish: bool = True) -> Optional[str]:
+		"""Look up a user and run the selected actions, returning the generated password.
+
+		With finish=False the caller runs finish_user once any deferred steps are done.
+		"""
+		if self.journal and self.journal.is_resumed:
+			self.add_result("Resume", "info", f"Resuming run {self.journal.run_id}")
+
+		# AD and Graph lookups are independent, so run them concurrently
+		ad_lookup = self.find_ad_user(user_email) if ad_actions_needed(actions) else _none()
+		graph_lookup = self.find_graph_user(user_email) if m365_actions_needed(actions) else _none()
+		ad_user, graph_user = await asyncio.gather(ad_lookup, graph_lookup)
+		self.graph_user = graph_user
+
+		password = self.prepare_password(ad_user, graph_user)
+		if not password:
+			return None
+
+		for step, target_id, action, args in self.plan_steps(actions, ad_user, graph_user, password):
+			await self.run_step(user_email, step, target_id, action, *args)
+
+		return self.finish_user(user_email, actions, password) if finish else password
+
+	# Active Directory facade
+
+	async def connect_ad_with_credentials(self, username: str, password: str) -> bool:
+		return await self._run_ad(super().connect_ad_with_credentials, username, password)
+
+	async def find_ad_user(self, email: str):
+		return await self._run_ad(super().find_ad_user, email)
+
+	async def disable_ad_account(self, user_dn: str, current_uac: Optional[int] = None) -> bool:
+		return await self._run_ad(super().disable_ad_account, user_dn, current_uac)
+
+	async def set_ad_expiration(self, user_dn: str, current_expires=None) -> bool:
+		return await self._run_ad(super().set_ad_expiration, user_dn, current_expires)
+
+	async def reset_ad_password(self, user_dn: str, password: str) -> bool:
+		return await self._run_ad(super().reset_ad_password, user_dn, password)
+
+	async def move_ad_user(self, user_dn: str) -> bool:
+		return await self._run_ad(super().move_ad_user, user_dn)
+
+	# Microsoft Graph actions
+
+	async def find_graph_user(self, email: str):
+		"""Find user in Microsoft Graph by email"""
+		try:
+			response = await self.graph.get(f"/users/{email}", params={'$select': GRAPH_USER_SELECT})
+
+			if response.status_code == 200:
+				user = response.json()
+				self.add_result("Graph User Search", "success", f"Found M365 user: {user['displayName']}")
+				return user
+			elif response.status_code == 404:
+				self.add_result("Graph User Search", "warning", f"User not found in M365: {email}")
+				return None
+			elif response.status_code == 401:
+				self.add_result("Graph User Search", "error", "Access token expired or insufficient permissions")
+				return None
+			else:
+				self.add_result("Graph User Search", "error", f"Graph user search failed: {response.text}")
+				return None
+
+		except Exception as e:
+			self.add_result("Graph User Search", "error", f"Graph user search exception: {str(e)}")
+			return None
+
+	async def disable_m365_account(self, user_id: str, account_enabled: Optional[bool] = None) -> bool:
+		"""Disable Microsoft 365 account"""
+		if account_enabled is False:
+			self.add_result("M365 Disable", "info", "M365 account already disabled")
+			return True
+
+		try:
+			response = await self.graph.patch(f"/users/{user_id}", json={'accountEnabled': False})
+
+			if response.status_code == 204:
+				self.add_result("M365 Disable", "success", "M365 account disabled successfully")
+				return True
+			elif response.status_code == 403:
+				self.add_result("M365 Disable", "error", "Insufficient permissions to disable M365 account")
+				return False
+			else:
+				self.add_result("M365 Disable", "error", f"Failed to disable M365 account: {response.text}")
+				return False
+
+		except Exception as e:
+			self.add_result("M365 Disable", "error", f"M365 disable exception: {str(e)}")
+			return False
+
+	async def revoke_m365_sessions(self, user_id: str) -> bool:
+		"""Revoke all Microsoft 365 sessions"""
+		try:
+			response = await self.graph.post(f"/users/{user_id}/revokeSignInSessions")
+
+			if response.status_code == 200:
+				result = response.json()
+				self.add_result("M365 Sessions", "success", f"All M365 sessions revoked successfully: {result.get('value', 'Success')}")
+				return True
+			elif response.status_code == 403:
+				self.add_result("M365 Sessions", "error", "Insufficient permissions to revoke sessions")
+				return False
+			else:
+				self.add_result("M365 Sessions", "error", f"Failed to revoke sessions: {response.text}")
+				return False
+
+		except Exception as e:
+			self.add_result("M365 Sessions", "error", f"M365 session revocation exception: {str(e)}")
+			return False
+
+	async def remove_m365_licenses(self, user_id: str, licenses: Optional[Dict] = None) -> bool:
+		"""Remove the directly assigned licenses from a Microsoft 365 account"""
+		try:
+			if licenses is None:
+				response = await self.graph.get(f"/users/{user_id}", params={'$select': GRAPH_LICENSE_SELECT})
+				if response.status_code != 200:
+					self.add_result("M365 Licenses", "error", f"Failed to read assigned licenses: {response.text}")
+					return False
+				licenses = response.json()
+
+			sku_ids = await self.license_skus_to_remove(licenses)
+			if not sku_ids:
+				return True
+
+			response = await self.graph.post(f"/users/{user_id}/assignLicense",
+											 json={'addLicenses': [], 'removeLicenses': sku_ids})
+			return await self.record_license_removal(sku_ids, response.status_code, response.text)
+
+		except Exception as e:
+			self.add_result("M365 Licenses", "error", f"License removal exception: {str(e)}")
+			return False
+
+	async def license_skus_to_remove(self, licenses: Dict) -> List[str]:
+		"""Return the directly assigned SKUs, reporting group-assigned ones that cannot be removed here"""
+		sku_ids, group_skus = split_license_assignments(licenses)
+		if group_skus or not sku_ids:
+			sku_names = await self.graph.get_sku_part_numbers() if group_skus else {}
+			self.report_license_assignments(sku_ids, group_skus, sku_names)
+		return sku_ids
+
+	async def record_license_removal(self, sku_ids: List[str], status_code: int, body) -> bool:
+		"""Add the result of an assignLicense call, whether sent directly or through $batch"""
+		if status_code == 200:
+			sku_names = await self.graph.get_sku_part_numbers()
+			reclaimed = [sku_names.get(sku_id, sku_id) for sku_id in sku_ids]
+			self.add_result("M365 Licenses", "success", f"Reclaimed {len(sku_ids)} licenses: {', '.join(reclaimed)}",
+							{'reclaimedSkus': reclaimed})
+			return True
+		elif status_code == 403:
+			self.add_result("M365 Licenses", "error", "Insufficient permissions to remove licenses")
+			return False
+		else:
+			self.add_result("M365 Licenses", "error", f"Failed to remove licenses: {body}")
+			return False
+
+	async def remove_mfa_methods(self, user_id: str) -> bool:
+		"""Remove all MFA authentication methods, deleting them concurrently"""
+		try:
+			phone_url = f"/users/{user_id}/authentication/phoneMethods"
+			auth_url = f"/users/{user_id}/authentication/microsoftAuthenticatorMethods"
+			phone_response, auth_response = await asyncio.gather(
+				self.graph.get(phone_url),
+				self.graph.get(auth_url)
+			)
+
+			if phone_response.status_code == 403:
+				self.add_result("MFA Cleanup", "error", "Insufficient permissions to access MFA methods")
+				return False
+
+			deletions = []
+			if phone_response.status_code == 200:
+				for method in phone_response.json().get('value', []):
+					deletions.append((phone_url, method, f"phone method: {method.get('phoneType', 'Unknown')}"))
+			if auth_response.status_code == 200:
+				for method in auth_response.json().get('value', []):
+					deletions.append((auth_url, method, f"authenticator method: {method['id']}"))
+
+			delete_responses = await asyncio.gather(*(
+				self.graph.delete(f"{url}/{method['id']}") for url, method, _ in deletions
+			))
+
+			removed_count = 0
+			for (url, method, description), delete_response in zip(deletions, delete_responses):
+				if delete_response.status_code == 204:
+					removed_count += 1
+					self.add_result("MFA Cleanup", "success", f"Removed {description}")
+				else:
+					self.add_result("MFA Cleanup", "warning", f"Failed to remove {description.split(':')[0]}: {method['id']}")
+
+			if removed_count > 0:
+				self.add_result("MFA Cleanup", "success", f"Successfully removed {removed_count} MFA methods")
+			else:
+				self.add_result("MFA Cleanup", "info", "No MFA methods found to remove")
+
+			return True
+
+		except Exception as e:
+			self.add_result("MFA Cleanup", "error", f"MFA cleanup exception: {str(e)}")
+			return False
+
+
+async def _none():
+	return None
+
+
+@asynccontextmanager
+async def _graph_client(access_token: Optional[str]):
+	# AD-only runs have no token and never call Graph
+	if not access_token:
+		yield None
+		return
+	async with AsyncGraphClient(access_token) as graph:
+		yield graph
+
+
+@asynccontextmanager
+async def _journal_writer(journal):
+	if not journal:
+		yield None
+		return
+	async with AsyncJournalWriter(journal) as writer:
+		yield writer
+
+
+async def deprovision_many(user_emails: List[str], actions: Dict, access_token: str,
+						   ad_connection=None, journal=None, concurrency: Optional[int] = None,
+						   on_result=None) -> Dict[str, Dict]:
+	"""Deprovision many users on one event loop, sharing the Graph pool and AD connection.
+
+	on_result, if given, is called with (user_email, result) as each result is added.
+	An email listed more than once (in any case) runs once, under its first spelling.
+	License reclamation is taken out of the per-user pipelines and done for
+	everyone at the end through $batch; users are reported complete after it.
+	"""
+	unique_emails = {}
+	for user_email in user_emails:
+		unique_emails.setdefault(user_email.lower(), user_email)
+	user_emails = list(unique_emails.values())
+
+	concurrency = concurrency or Config.ASYNC_CONCURRENCY
+	semaphore = asyncio.Semaphore(concurrency)
+	ad_lock = asyncio.Lock()
+	services = {}
+	passwords = {}
+
+	reclaim_licenses = bool(actions.get('m365Actions') and actions.get('reclaimLicenses'))
+	user_actions = {**actions, 'reclaimLicenses': False} if reclaim_licenses else actions
+
+	async with _graph_client(access_token) as graph, _journal_writer(journal) as journal_writer:
+		async def run_one(user_email: str):
+			async with semaphore:
+				service = AsyncUserDeprovisioningService(graph, ad_lock)
+				service.ad_connection = ad_connection
+				service.journal = journal
+				service.journal_writer = journal_writer
+				if on_result:
+					service.on_result = functools.partial(on_result, user_email)
+				services[user_email] = service
+				try:
+					passwords[user_email] = await service.deprovision_user(user_email, user_actions, finish=False)
+				except Exception as e:
+					logger.exception(f"Deprovisioning failed for {user_email}")
+					service.add_result("Error", "error", f"Deprovisioning exception: {str(e)}")
+
+		await asyncio.gather(*(run_one(user_email) for user_email in user_emails))
+
+		if reclaim_licenses and graph:
+			await reclaim_licenses_batched(graph, services)
+
+	outcomes = {}
+	for user_email in user_emails:
+		service = services[user_email]
+		password = passwords.get(user_email)
+		if password:
+			password = service.finish_user(user_email, actions, password)
+		outcomes[user_email] = {'results': service.results, 'password': password}
+	return outcomes
+
+
+async def reclaim_licenses_batched(graph: AsyncGraphClient, services: Dict[str, AsyncUserDeprovisioningService]):
+	"""Remove the licenses of every looked-up user with $batch, adding results to each user's service"""
+	pending = {}
+	unlicensed = []
+	for user_email, service in services.items():
+		if not service.graph_user:
+			continue
+		if service.journal and service.journal.is_completed(user_email, 'reclaimLicenses'):
+			service.add_result("Resume", "info", "Skipping reclaimLicenses: already completed in a previous attempt")
+			continue
+
+		sku_ids = await service.license_skus_to_remove(service.graph_user)
+		if not sku_ids:
+			unlicensed.append(service.record_step(user_email, 'reclaimLicenses', service.graph_user['id'], True))
+			continue
+
+		pending[str(len(pending))] = (user_email, service, sku_ids)
+
+	await asyncio.gather(*unlicensed)
+	if not pending:
+		return
+
+	responses = await graph.batch([
+		{
+			'id': request_id,
+			'method': 'POST',
+			'url': f"/users/{service.graph_user['id']}/assignLicense",
+			'headers': {'Content-Type': 'application/json'},
+			'body': {'addLicenses': [], 'removeLicenses': sku_ids}
+		}
+		for request_id, (user_email, service, sku_ids) in pending.items()
+	])
+
+	async def record(request_id: str, user_email: str, service: AsyncUserDeprovisioningService, sku_ids: List[str]):
+		response = responses.get(request_id, {'status': 0, 'body': 'No response in batch'})
+		success = await service.record_license_removal(sku_ids, response['status'], response.get('body'))
+		await service.record_step(user_email, 'reclaimLicenses', service.graph_user['id'], success)
+
+	# Journal records for every user share the writer's next fsync
+	await asyncio.gather(*(record(request_id, *pending[request_id]) for request_id in pending))
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# cli.py - Headless command-line runner for the deprovisioning service
+#
+# Heavy dependencies (msal, ldap3, requests, httpx) are imported inside the
+# command functions so that --help and argument errors return immediately.
+import os
+import sys
+import csv
+import json
+import getpass
+import logging
+import argparse
+
+
+DEFAULT_ACTIONS = 'disableAD,expireAD,resetADPassword,disableM365,revokeSessions,reclaimLicenses,removeMFA,moveToTerminated'
+
+
+def emit(record: dict):
+	"""Write one NDJSON record to stdout"""
+	sys.stdout.write(json.dumps(record) + '\n')
+	sys.stdout.flush()
+
+
+def acquire_token(auth_mode: str) -> str:
+	"""Acquire a Graph access token with client credentials or the device code flow"""
+	import msal
+	from config import Config
+
+	if auth_mode == 'client-credentials':
+		auth_app = msal.ConfidentialClientApplication(
+			Config.GRAPH_CLIENT_ID,
+			authority=Config.GRAPH_AUTHORITY,
+			client_credential=Config.GRAPH_CLIENT_SECRET
+		)
+		result = auth_app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+	else:
+		auth_app = msal.PublicClientApplication(Config.GRAPH_CLIENT_ID, authority=Config.GRAPH_AUTHORITY)
+		flow = auth_app.initiate_device_flow(scopes=Config.GRAPH_SCOPES)
+		if 'user_code' not in flow:
+			raise RuntimeError(f"Could not start device code flow: {flow.get('error_description', flow)}")
+		# Instructions go to stderr so stdout stays pure NDJSON
+		print(flow['message'], file=sys.stderr)
+		result = auth_app.acquire_token_by_device_flow(flow)
+
+	if 'access_token' not in result:
+		raise RuntimeError(f"Authentication failed: {result.get('error_description', result.get('error'))}")
+	return result['access_token']
+
+
+def read_targets(csv_path: str, default_actions: str):
+	"""Read (email, action ids) pairs from a CSV with an 'email' and optional 'actions' column"""
+	csv_file = sys.stdin if csv_path == '-' else open(csv_path, newline='', encoding='utf-8-sig')
+	try:
+		reader = csv.DictReader(csv_file)
+		if 'email' not in (reader.fieldnames or []):
+			raise ValueError(f"{csv_path} has no 'email' column")
+		return [(row['email'].strip(), (row.get('actions') or '').strip() or default_actions)
+				for row in reader if row['email'] and row['email'].strip()]
+	finally:
+		if csv_file is not sys.stdin:
+			csv_file.close()
+
+
+def parse_action_ids(action_ids: str):
+	return [action.strip() for action in action_ids.split(',') if action.strip()]
+
+
+def get_ad_password(args) -> str:
+	"""Read the AD password from the environment, or prompt for it on the terminal"""
+	password = os.environ.get('AD_PASSWORD')
+	if password:
+		return password
+	if not sys.stdin.isatty():
+		raise ValueError("Set AD_PASSWORD when not running interactively")
+	return getpass.getpass(f"AD password for {args.ad_username}: ")
+
+
+def cmd_deprovision(args) -> int:
+	"""Deprovision one user or every user in a CSV, streaming results as NDJSON"""
+	from user_deprovisioning_service import (
+		UserDeprovisioningService, build_actions, ad_actions_needed, m365_actions_needed, summarize_reclaimed_skus
+	)
+	from deprovisioning_journal import DeprovisioningJournal
+
+	targets = [(args.user, args.actions)] if args.user else read_targets(args.csv, args.actions)
+
+	# A user listed twice runs once, with the actions from their first row
+	unique_targets = {}
+	for user_email, action_ids in targets:
+		unique_targets.setdefault(user_email.lower(), (user_email, action_ids))
+	if len(unique_targets) < len(targets):
+		print(f"Skipping {len(targets) - len(unique_targets)} duplicate rows", file=sys.stderr)
+	targets = list(unique_targets.values())
+
+	# Users sharing the same action set run together as one batch
+	batches = {}
+	for user_email, action_ids in targets:
+		batches.setdefault(action_ids, []).append(user_email)
+	actions_by_batch = {action_ids: build_actions(parse_action_ids(action_ids)) for action_ids in batches}
+
+	journal = DeprovisioningJournal.open_run(args.run_id)
+	emit({'type': 'run', 'runId': journal.run_id, 'users': len(targets)})
+
+	service = UserDeprovisioningService()
+	service.on_result = lambda result: emit({'type': 'result', 'user': None, **result})
+	service.journal = journal
+	if any(m365_actions_needed(actions) for actions in actions_by_batch.values()):
+		service.graph_client = acquire_token(args.auth)
+
+	if any(ad_actions_needed(actions) for actions in actions_by_batch.values()):
+		if not args.ad_username:
+			raise ValueError("--ad-username (or AD_USERNAME) is required for AD actions")
+		if not service.connect_ad_with_credentials(args.ad_username, get_ad_password(args)):
+			return 1
+
+	outcomes = {}
+	try:
+		if len(targets) == 1:
+			user_email = targets[0][0]
+			service.on_result = lambda result: emit({'type': 'result', 'user': user_email, **result})
+			password = service.deprovision_user(user_email, actions_by_batch[targets[0][1]])
+			outcomes[user_email] = {'results': service.results, 'password': password}
+			emit({'type': 'summary', 'user': user_email, 'password': password})
+		else:
+			import asyncio
+			from async_deprovisioning_service import deprovision_many
+
+			for action_ids, user_emails in batches.items():
+				batch_outcomes = asyncio.run(deprovision_many(
+					user_emails,
+					actions_by_batch[action_ids],
+					service.graph_client,
+					ad_connection=service.ad_connection,
+					journal=journal,
+					concurrency=args.concurrency,
+					on_result=lambda user_email, result: emit({'type': 'result', 'user': user_email, **result})
+				))
+				for user_email, outcome in batch_outcomes.items():
+					emit({'type': 'summary', 'user': user_email, 'password': outcome['password']})
+				outcomes.update(batch_outcomes)
+	finally:
+		if service.ad_connection:
+			service.ad_connection.unbind()
+
+	reclaimed = summarize_reclaimed_skus(result for outcome in outcomes.values() for result in outcome['results'])
+	if reclaimed:
+		emit({'type': 'licenses', 'reclaimed': reclaimed})
+
+	completed = sum(1 for outcome in outcomes.values()
+					if any(result['action'] == 'Complete' for result in outcome['results']))
+	return 0 if completed == len(targets) else 1
+
+
+def cmd_reconcile(args) -> int:
+	"""Report mismatches between AD and Entra ID as NDJSON, optionally writing a fix queue CSV"""
+	from user_deprovisioning_service import UserDeprovisioningService
+	from directory_reconciliation import iter_ad_users, iter_graph_users, reconcile
+
+	if not args.ad_username:
+		raise ValueError("--ad-username (or AD_USERNAME) is required")
+
+	access_token = acquire_token(args.auth)
+	service = UserDeprovisioningService()
+	service.on_result = lambda result: print(f"{result['action']}: {result['message']}", file=sys.stderr)
+	if not service.connect_ad_with_credentials(args.ad_username, get_ad_password(args)):
+		return 1
+
+	fixes_file = open(args.fixes_csv, 'w', newline='', encoding='utf-8') if args.fixes_csv else None
+	try:
+		fixes = csv.DictWriter(fixes_file, fieldnames=['email', 'actions', 'mismatch']) if fixes_file else None
+		if fixes:
+			fixes.writeheader()
+
+		queued = 0
+		for record in reconcile(iter_ad_users(service.ad_connection, args.search_base), iter_graph_users(access_token)):
+			emit(record)
+			if fixes and record['type'] == 'mismatch' and record['fix'] and record['fixTarget']:
+				# Queue under the identity the fixing side resolves: UPN for Graph, mail or UPN for AD
+				fixes.writerow({'email': record['fixTarget'], 'actions': ','.join(record['fix']),
+								'mismatch': record['mismatch']})
+				queued += 1
+	finally:
+		service.ad_connection.unbind()
+		if fixes_file:
+			fixes_file.close()
+
+	if fixes_file:
+		print(f"Queued {queued} fixes in {args.fixes_csv}; apply with 'deprovision --csv {args.fixes_csv}'",
+			  file=sys.stderr)
+	return 0
+
+
+def cmd_sweep(args) -> int:
+	"""Stream stale AD accounts as NDJSON, or as a CSV that 'deprovision --csv -' accepts"""
+	from config import Config
+	from user_deprovisioning_service import UserDeprovisioningService
+	from stale_account_sweep import iter_stale_accounts
+
+	if not args.ad_username:
+		raise ValueError("--ad-username (or AD_USERNAME) is required")
+
+	service = UserDeprovisioningService()
+	# Connection messages go to stderr so stdout can be piped into another command
+	service.on_result = lambda result: print(f"{result['action']}: {result['message']}", file=sys.stderr)
+	if not service.connect_ad_with_credentials(args.ad_username, get_ad_password(args)):
+		return 1
+
+	fields = ['email', 'sAMAccountName', 'reason', 'lastLogon', 'pwdLastSet', 'accountExpires', 'dn']
+	writer = csv.DictWriter(sys.stdout, fieldnames=fields) if args.format == 'csv' else None
+	if writer:
+		writer.writeheader()
+
+	found = 0
+	without_email = 0
+	try:
+		for candidate in iter_stale_accounts(
+			service.ad_connection,
+			args.inactive_days or Config.STALE_INACTIVE_DAYS,
+			password_age_days=args.password_age_days,
+			include_non_expiring=args.include_non_expiring,
+			search_base=args.search_base
+		):
+			found += 1
+			if not writer:
+				emit({'type': 'candidate', **candidate})
+			elif candidate['email']:
+				writer.writerow(candidate)
+			else:
+				# Deprovisioning is keyed by email, so these cannot be fed forward
+				without_email += 1
+	finally:
+		service.ad_connection.unbind()
+
+	print(f"Sweep complete: {found} candidates, {without_email} skipped for having no email", file=sys.stderr)
+	return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+	parser = argparse.ArgumentParser(description="Headless runner for the User Deprovisioning Tool")
+	parser.add_argument('--log-level', default='WARNING', help="Log level for messages on stderr (default: WARNING)")
+	subparsers = parser.add_subparsers(dest='command', required=True)
+
+	ad_options = argparse.ArgumentParser(add_help=False)
+	ad_options.add_argument('--ad-username', default=os.environ.get('AD_USERNAME'),
+							help="AD username; the password is read from AD_PASSWORD or prompted for")
+
+	graph_options = argparse.ArgumentParser(add_help=False)
+	graph_options.add_argument('--auth', choices=['client-credentials', 'device-code'], default='client-credentials',
+							   help="How to authenticate to Microsoft Graph (default: client-credentials)")
+
+	deprovision = subparsers.add_parser('deprovision', parents=[ad_options, graph_options],
+										help="Deprovision a user or a CSV of users")
+	target = deprovision.add_mutually_exclusive_group(required=True)
+	target.add_argument('--user', help="Email of the user to deprovision")
+	target.add_argument('--csv', help="CSV file with an 'email' and optional 'actions' column ('-' for stdin)")
+	deprovision.add_argument('--actions', default=DEFAULT_ACTIONS,
+							 help=f"Comma-separated action ids (default: {DEFAULT_ACTIONS})")
+	deprovision.add_argument('--run-id', help="Resume an earlier run with this id")
+	deprovision.add_argument('--concurrency', type=int, help="Users in flight at once for CSV runs")
+	deprovision.set_defaults(func=cmd_deprovision)
+
+	sweep = subparsers.add_parser('sweep', parents=[ad_options], help="Find stale AD accounts to deprovision")
+	sweep.add_argument('--inactive-days', type=int, help="Days since last logon (default: STALE_INACTIVE_DAYS or 90)")
+	sweep.add_argument('--password-age-days', type=int, help="Days since the password was set (default: --inactive-days)")
+	sweep.add_argument('--include-non-expiring', action='store_true',
+					   help="Include accounts whose password never expires (usually service accounts)")
+	sweep.add_argument('--search-base', help="Search base (default: AD_SEARCH_BASE)")
+	sweep.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson',
+					   help="csv output can be piped into 'deprovision --csv -'")
+	sweep.set_defaults(func=cmd_sweep)
+
+	reconcile = subparsers.add_parser('reconcile', parents=[ad_options, graph_options],
+									  help="Report mismatches between AD and Entra ID")
+	reconcile.add_argument('--search-base', help="Search base (default: AD_SEARCH_BASE)")
+	reconcile.add_argument('--fixes-csv', help="Write suggested fixes to a CSV that 'deprovision --csv' accepts")
+	reconcile.set_defaults(func=cmd_reconcile)
+
+	return parser
+
+
+def main(argv=None) -> int:
+	args = build_parser().parse_args(argv)
+	logging.basicConfig(
+		level=getattr(logging, args.log_level.upper(), logging.WARNING),
+		format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+	)
+
+	try:
+		return args.func(args)
+	except (ValueError, RuntimeError) as e:
+		print(f"Error: {e}", file=sys.stderr)
+		return 2
+
+
+if __name__ == '__main__':
+	sys.exit(main())
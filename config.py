@@ -1,6 +1,6 @@
 # config.py - Full M365 Support Configuration
 import os
-from decouple import config
+from decouple import config, Csv
 
 
 class Config:
@@ -14,17 +14,47 @@ class Config:
 	GRAPH_CLIENT_SECRET = config('GRAPH_CLIENT_SECRET', default='')
 	GRAPH_TENANT_ID = config('GRAPH_TENANT_ID', default='')
 	GRAPH_AUTHORITY = f"https://login.microsoftonline.com/{config('GRAPH_TENANT_ID', default='common')}"
+	GRAPH_SCOPES = [
+		"User.ReadWrite.All",
+		"Directory.ReadWrite.All",
+		"UserAuthenticationMethod.ReadWrite.All",
+		"Group.ReadWrite.All"
+	]
 	
 	# Active Directory Configuration
-	AD_SERVER = config('AD_SERVER', default='')
+	AD_SERVER = config('AD_SERVER', default='', cast=Csv())  # one or more DCs: host, host:port or ldap(s)://host[:port]
 	AD_PORT = config('AD_PORT', default=389, cast=int)
 	AD_USE_SSL = config('AD_USE_SSL', default=False, cast=bool)
+	AD_CONNECT_TIMEOUT = config('AD_CONNECT_TIMEOUT', default=5, cast=int)
+	AD_PROBE_TIMEOUT = config('AD_PROBE_TIMEOUT', default=1.0, cast=float)  # DC latency probe
+	AD_PROBE_CACHE_SECONDS = config('AD_PROBE_CACHE_SECONDS', default=30, cast=int)
+	AD_POOL_EXHAUST_SECONDS = config('AD_POOL_EXHAUST_SECONDS', default=60, cast=int)  # failed DC cool-off
 	AD_SEARCH_BASE = config('AD_SEARCH_BASE', default='')
+	AD_PAGE_SIZE = config('AD_PAGE_SIZE', default=500, cast=int)  # entries per paged search page
 	AD_TERMINATED_OU = config('AD_TERMINATED_OU', default='OU=Terminated Users,DC=domain,DC=com')
 	
 	# Application Settings
 	REQUIRE_CONFIRMATION = config('REQUIRE_CONFIRMATION', default=True, cast=bool)
 	LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+	JOURNAL_DIR = config('JOURNAL_DIR', default='journal')  # per-run checkpoint journals
+	
+	# Bulk Run Settings
+	ASYNC_CONCURRENCY = config('ASYNC_CONCURRENCY', default=200, cast=int)  # users in flight at once
+	GRAPH_MAX_CONNECTIONS = config('GRAPH_MAX_CONNECTIONS', default=50, cast=int)
+	
+	# Stale Account Sweep
+	STALE_INACTIVE_DAYS = config('STALE_INACTIVE_DAYS', default=90, cast=int)
+	
+	# Scheduled Deprovisioning (runs unattended with client credentials and a service account)
+	SCHEDULER_ENABLED = config('SCHEDULER_ENABLED', default=False, cast=bool)
+	SCHEDULE_DB = config('SCHEDULE_DB', default='schedule.db')
+	SCHEDULER_POLL_SECONDS = config('SCHEDULER_POLL_SECONDS', default=60, cast=int)  # store re-read interval
+	SCHEDULER_BATCH_SIZE = config('SCHEDULER_BATCH_SIZE', default=1000, cast=int)  # jobs claimed per wake-up
+	SCHEDULER_LEASE_SECONDS = config('SCHEDULER_LEASE_SECONDS', default=300, cast=int)  # running job ownership
+	SCHEDULER_OFF_PEAK_START = config('SCHEDULER_OFF_PEAK_START', default=22, cast=int)  # local hour
+	SCHEDULER_OFF_PEAK_END = config('SCHEDULER_OFF_PEAK_END', default=5, cast=int)
+	SCHEDULER_AD_USERNAME = config('SCHEDULER_AD_USERNAME', default='')
+	SCHEDULER_AD_PASSWORD = config('SCHEDULER_AD_PASSWORD', default='')
 	
 	@classmethod
 	def validate_config(cls):
@@ -36,6 +66,8 @@ class Config:
 			'AD_SERVER',
 			'AD_SEARCH_BASE'
 		]
+		if cls.SCHEDULER_ENABLED:
+			required_fields += ['SCHEDULER_AD_USERNAME', 'SCHEDULER_AD_PASSWORD']
    	 
 		missing = []
 		for field in required_fields:
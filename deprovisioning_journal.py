@@ -0,0 +1,100 @@
+# deprovisioning_journal.py - Resumable checkpoint journal for deprovisioning runs
+import os
+import json
+import uuid
+import logging
+from datetime import datetime
+from typing import List, Optional, Tuple
+from config import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeprovisioningJournal:
+	"""Append-only, per-run record of completed deprovisioning steps.
+
+	Each line of the journal file is a JSON object with the user, step id,
+	target id and outcome. A resumed run with the same run id skips every
+	step that already finished successfully for that user.
+	"""
+
+	def __init__(self, run_id: str, path: str):
+		self.run_id = run_id
+		self.path = path
+		self._completed = {}
+		self._load()
+		self._previous = set(self._completed)
+
+	@classmethod
+	def open_run(cls, run_id: Optional[str] = None, journal_dir: Optional[str] = None):
+		"""Open the journal for an existing run, or start a new one when no id is given"""
+		if run_id:
+			# Run ids become file names, so only accept canonical UUIDs
+			run_id = str(uuid.UUID(run_id))
+		else:
+			run_id = str(uuid.uuid4())
+
+		journal_dir = journal_dir or Config.JOURNAL_DIR
+		os.makedirs(journal_dir, exist_ok=True)
+		return cls(run_id, os.path.join(journal_dir, f"{run_id}.jsonl"))
+
+	def _load(self):
+		"""Load completed steps from a previous attempt of this run"""
+		if not os.path.exists(self.path):
+			return
+
+		with open(self.path, 'r', encoding='utf-8') as journal_file:
+			for line in journal_file:
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					# A crash mid-write can leave a truncated last line
+					logger.warning(f"Ignoring malformed journal line in {self.path}")
+					continue
+
+				key = (entry['user'].lower(), entry['step'])
+				if entry['outcome'] == 'success':
+					self._completed[key] = entry
+				else:
+					self._completed.pop(key, None)
+
+		logger.info(f"Resuming run {self.run_id}: {len(self._completed)} completed steps loaded")
+
+	@property
+	def is_resumed(self) -> bool:
+		return bool(self._previous)
+
+	def is_completed(self, user: str, step: str) -> bool:
+		"""Check whether a step already completed for a user in this run"""
+		return (user.lower(), step) in self._completed
+
+	def was_completed_before(self, user: str, step: str) -> bool:
+		"""Check whether a step completed in an earlier attempt, before this journal was opened"""
+		return (user.lower(), step) in self._previous
+
+	def record(self, user: str, step: str, target_id: str, outcome: str):
+		"""Durably append the outcome of a step before moving on to the next one"""
+		self.record_many([(user, step, target_id, outcome)])
+
+	def record_many(self, records: List[Tuple[str, str, str, str]]):
+		"""Durably append several (user, step, target id, outcome) records with a single fsync"""
+		entries = [{
+			'user': user,
+			'step': step,
+			'target': target_id,
+			'outcome': outcome,
+			'timestamp': datetime.now().isoformat()
+		} for user, step, target_id, outcome in records]
+
+		with open(self.path, 'a', encoding='utf-8') as journal_file:
+			journal_file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+			journal_file.flush()
+			os.fsync(journal_file.fileno())
+
+		for entry in entries:
+			key = (entry['user'].lower(), entry['step'])
+			if entry['outcome'] == 'success':
+				self._completed[key] = entry
+			else:
+				self._completed.pop(key, None)
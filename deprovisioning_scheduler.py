@@ -0,0 +1,385 @@
+# deprovisioning_scheduler.py - Persistent schedule of deprovisioning jobs with batched execution
+import os
+import json
+import uuid
+import heapq
+import socket
+import sqlite3
+import asyncio
+import logging
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from config import Config
+
+
+logger = logging.getLogger(__name__)
+
+
+JOB_STATUSES = ('pending', 'running', 'done', 'failed', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+	id TEXT PRIMARY KEY,
+	user_email TEXT NOT NULL,
+	actions TEXT NOT NULL,
+	run_at REAL NOT NULL,
+	off_peak INTEGER NOT NULL DEFAULT 0,
+	status TEXT NOT NULL DEFAULT 'pending',
+	run_id TEXT,
+	owner TEXT,
+	lease_until REAL,
+	created_by TEXT,
+	created_at REAL NOT NULL,
+	finished_at REAL,
+	summary TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at);
+"""
+
+
+def in_off_peak_window(moment: datetime, start_hour: int, end_hour: int) -> bool:
+	"""Check whether a local time falls in the off-peak window, which may wrap past midnight"""
+	if start_hour > end_hour:
+		return moment.hour >= start_hour or moment.hour < end_hour
+	return start_hour <= moment.hour < end_hour
+
+
+def next_off_peak(timestamp: float, start_hour: Optional[int] = None, end_hour: Optional[int] = None) -> float:
+	"""Return the timestamp itself if it is off-peak, otherwise the start of the next off-peak window"""
+	start_hour = Config.SCHEDULER_OFF_PEAK_START if start_hour is None else start_hour
+	end_hour = Config.SCHEDULER_OFF_PEAK_END if end_hour is None else end_hour
+
+	moment = datetime.fromtimestamp(timestamp)
+	if in_off_peak_window(moment, start_hour, end_hour):
+		return timestamp
+
+	window_start = moment.replace(hour=start_hour, minute=0, second=0, microsecond=0)
+	if window_start <= moment:
+		window_start += timedelta(days=1)
+	return window_start.timestamp()
+
+
+def parse_run_at(value: str) -> float:
+	"""Parse an ISO 8601 time to a timestamp; times without an offset are server-local"""
+	return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def _isoformat(timestamp: Optional[float]) -> Optional[str]:
+	return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat() if timestamp else None
+
+
+class ScheduleStore:
+	"""SQLite-backed job store; safe to share between threads and worker processes"""
+
+	def __init__(self, path: Optional[str] = None):
+		self.path = path or Config.SCHEDULE_DB
+		with closing(self._connect()) as db:
+			db.execute('PRAGMA journal_mode=WAL')
+			db.executescript(SCHEMA)
+
+	def _connect(self) -> sqlite3.Connection:
+		db = sqlite3.connect(self.path, timeout=30)
+		db.row_factory = sqlite3.Row
+		return db
+
+	@staticmethod
+	def to_dict(row: sqlite3.Row) -> Dict:
+		return {
+			'id': row['id'],
+			'userEmail': row['user_email'],
+			'actions': json.loads(row['actions']),
+			'runAt': _isoformat(row['run_at']),
+			'offPeak': bool(row['off_peak']),
+			'status': row['status'],
+			'runId': row['run_id'],
+			'createdBy': row['created_by'],
+			'createdAt': _isoformat(row['created_at']),
+			'finishedAt': _isoformat(row['finished_at']),
+			'summary': json.loads(row['summary']) if row['summary'] else None
+		}
+
+	def add(self, jobs: List[Dict]) -> List[Dict]:
+		"""Insert jobs (dicts with user_email, actions, run_at, off_peak, created_by)"""
+		now = datetime.now(timezone.utc).timestamp()
+		rows = [(str(uuid.uuid4()), job['user_email'], json.dumps(job['actions'], sort_keys=True),
+				 job['run_at'], int(job['off_peak']), job.get('created_by'), now) for job in jobs]
+		with closing(self._connect()) as db, db:
+			db.executemany(
+				'INSERT INTO jobs (id, user_email, actions, run_at, off_peak, created_by, created_at) '
+				'VALUES (?, ?, ?, ?, ?, ?, ?)', rows
+			)
+		return [{'id': row[0], 'run_at': row[3]} for row in rows]
+
+	def get(self, job_id: str) -> Optional[Dict]:
+		with closing(self._connect()) as db:
+			row = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+		return self.to_dict(row) if row else None
+
+	def list(self, status: Optional[str] = None, limit: int = 100, offset: int = 0) -> List[Dict]:
+		query = 'SELECT * FROM jobs'
+		params = []
+		if status:
+			query += ' WHERE status = ?'
+			params.append(status)
+		query += ' ORDER BY run_at LIMIT ? OFFSET ?'
+		params.extend([limit, offset])
+		with closing(self._connect()) as db:
+			return [self.to_dict(row) for row in db.execute(query, params)]
+
+	def pending_before(self, until: float) -> List[tuple]:
+		"""Return (run_at, id) of pending jobs due before a time, using the status/run_at index"""
+		with closing(self._connect()) as db:
+			return [tuple(row) for row in db.execute(
+				"SELECT run_at, id FROM jobs WHERE status = 'pending' AND run_at <= ? ORDER BY run_at", (until,)
+			)]
+
+	def update_pending(self, job_id: str, **fields) -> bool:
+		"""Update a job that has not started yet; returns False if it is no longer pending"""
+		assignments = ', '.join(f'{name} = ?' for name in fields)
+		with closing(self._connect()) as db, db:
+			cursor = db.execute(f"UPDATE jobs SET {assignments} WHERE id = ? AND status = 'pending'",
+								(*fields.values(), job_id))
+			return cursor.rowcount == 1
+
+	def claim_due(self, job_ids: List[str], now: float, owner: str, lease_until: float) -> List[sqlite3.Row]:
+		"""Atomically move due jobs to running under a lease so no other worker picks them up"""
+		claimed = []
+		with closing(self._connect()) as db, db:
+			for job_id in job_ids:
+				cursor = db.execute(
+					"UPDATE jobs SET status = 'running', owner = ?, lease_until = ? "
+					"WHERE id = ? AND status = 'pending' AND run_at <= ?",
+					(owner, lease_until, job_id, now)
+				)
+				if cursor.rowcount == 1:
+					claimed.append(db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+		return claimed
+
+	def set_run_id(self, job_ids: List[str], run_id: str):
+		with closing(self._connect()) as db, db:
+			db.executemany('UPDATE jobs SET run_id = ? WHERE id = ?', [(run_id, job_id) for job_id in job_ids])
+
+	def renew_leases(self, owner: str, lease_until: float) -> int:
+		"""Extend the lease on every job an owner is still running"""
+		with closing(self._connect()) as db, db:
+			return db.execute("UPDATE jobs SET lease_until = ? WHERE status = 'running' AND owner = ?",
+							  (lease_until, owner)).rowcount
+
+	def finish(self, job_id: str, owner: str, status: str, summary: Dict):
+		"""Record a job's outcome, unless its lease was lost and another worker took it over"""
+		with closing(self._connect()) as db, db:
+			db.execute("UPDATE jobs SET status = ?, finished_at = ?, summary = ?, owner = NULL, lease_until = NULL "
+					   "WHERE id = ? AND status = 'running' AND owner = ?",
+					   (status, datetime.now(timezone.utc).timestamp(), json.dumps(summary), job_id, owner))
+
+	def requeue_expired(self, now: float) -> int:
+		"""Put running jobs whose owner stopped renewing its lease back in the queue.
+
+		Their run ids are kept, so the next attempt resumes from the run journal.
+		"""
+		with closing(self._connect()) as db, db:
+			return db.execute(
+				"UPDATE jobs SET status = 'pending', owner = NULL, lease_until = NULL "
+				"WHERE status = 'running' AND lease_until < ?", (now,)
+			).rowcount
+
+
+def run_scheduled_batch(user_emails: List[str], actions: Dict, run_id: str) -> Dict[str, Dict]:
+	"""Run one batch unattended, with an app-only Graph token and the scheduler's AD account"""
+	import msal
+	from user_deprovisioning_service import UserDeprovisioningService, ad_actions_needed
+	from async_deprovisioning_service import deprovision_many
+	from deprovisioning_journal import DeprovisioningJournal
+
+	auth_app = msal.ConfidentialClientApplication(
+		Config.GRAPH_CLIENT_ID,
+		authority=Config.GRAPH_AUTHORITY,
+		client_credential=Config.GRAPH_CLIENT_SECRET
+	)
+	token = auth_app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
+	if 'access_token' not in token:
+		raise RuntimeError(f"Scheduler authentication failed: {token.get('error_description', token.get('error'))}")
+
+	service = UserDeprovisioningService()
+	if ad_actions_needed(actions):
+		if not service.connect_ad_with_credentials(Config.SCHEDULER_AD_USERNAME, Config.SCHEDULER_AD_PASSWORD):
+			raise RuntimeError(service.results[-1]['message'])
+
+	try:
+		return asyncio.run(deprovision_many(
+			user_emails,
+			actions,
+			token['access_token'],
+			ad_connection=service.ad_connection,
+			journal=DeprovisioningJournal.open_run(run_id)
+		))
+	finally:
+		if service.ad_connection:
+			service.ad_connection.unbind()
+
+
+class DeprovisioningScheduler:
+	"""Wakes due jobs from a min-heap and runs them in batches on a background thread.
+
+	The heap holds (run_at, job_id) with lazy deletion: cancelling or
+	rescheduling only updates _scheduled, and stale heap entries are dropped
+	when they reach the top. Only jobs due within the next poll interval are
+	kept in memory; the store is re-read each interval, which also picks up
+	jobs scheduled by other worker processes.
+
+	Claimed jobs carry this scheduler's owner id and a lease that a heartbeat
+	thread renews while they run. Only jobs whose lease has expired, because
+	their worker died, are requeued, so several workers can share one store.
+	"""
+
+	def __init__(self, store: Optional[ScheduleStore] = None, runner=None):
+		self.store = store or ScheduleStore()
+		self.runner = runner or run_scheduled_batch
+		self.poll_seconds = Config.SCHEDULER_POLL_SECONDS
+		self.batch_size = Config.SCHEDULER_BATCH_SIZE
+		self.lease_seconds = Config.SCHEDULER_LEASE_SECONDS
+		self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+		self._heap = []
+		self._scheduled = {}  # job_id -> run_at of its live heap entry
+		self._condition = threading.Condition()
+		self._thread = None
+		self._heartbeat = None
+		self._stopped = False
+		self._stop_event = threading.Event()
+		self._horizon = 0.0
+
+	def start(self):
+		self._resync(datetime.now(timezone.utc).timestamp())
+		self._thread = threading.Thread(target=self._loop, name='deprovisioning-scheduler', daemon=True)
+		self._heartbeat = threading.Thread(target=self._renew_leases, name='deprovisioning-scheduler-lease', daemon=True)
+		self._thread.start()
+		self._heartbeat.start()
+		logger.info(f"Deprovisioning scheduler {self.owner} started with {len(self._scheduled)} jobs due soon")
+
+	def stop(self):
+		with self._condition:
+			self._stopped = True
+			self._condition.notify()
+		self._stop_event.set()
+		for thread in (self._thread, self._heartbeat):
+			if thread:
+				thread.join()
+
+	def _renew_leases(self):
+		while not self._stop_event.wait(self.lease_seconds / 3):
+			try:
+				self.store.renew_leases(self.owner, datetime.now(timezone.utc).timestamp() + self.lease_seconds)
+			except Exception:
+				logger.exception("Could not renew scheduled job leases")
+
+	def _push(self, job_id: str, run_at: float):
+		"""Track a job in the heap if it falls within the in-memory horizon"""
+		if run_at <= self._horizon:
+			self._scheduled[job_id] = run_at
+			heapq.heappush(self._heap, (run_at, job_id))
+		else:
+			self._scheduled.pop(job_id, None)
+
+	def _resync(self, now: float):
+		requeued = self.store.requeue_expired(now)
+		if requeued:
+			logger.warning(f"Requeued {requeued} scheduled jobs whose worker stopped renewing their lease")
+		self._horizon = now + self.poll_seconds
+		for run_at, job_id in self.store.pending_before(self._horizon):
+			if self._scheduled.get(job_id) != run_at:
+				self._push(job_id, run_at)
+
+	def schedule(self, user_emails: List[str], actions: Dict, run_at: float, off_peak: bool = False,
+				 created_by: Optional[str] = None) -> List[Dict]:
+		"""Add a job per user; off-peak jobs are pushed into the next off-peak window"""
+		if off_peak:
+			run_at = next_off_peak(run_at)
+		jobs = self.store.add([{'user_email': user_email, 'actions': actions, 'run_at': run_at,
+								'off_peak': off_peak, 'created_by': created_by} for user_email in user_emails])
+		with self._condition:
+			for job in jobs:
+				self._push(job['id'], job['run_at'])
+			self._condition.notify()
+		return [self.store.get(job['id']) for job in jobs]
+
+	def cancel(self, job_id: str) -> bool:
+		if not self.store.update_pending(job_id, status='cancelled'):
+			return False
+		with self._condition:
+			self._scheduled.pop(job_id, None)
+		return True
+
+	def reschedule(self, job_id: str, run_at: float, off_peak: bool = False) -> bool:
+		if off_peak:
+			run_at = next_off_peak(run_at)
+		if not self.store.update_pending(job_id, run_at=run_at, off_peak=int(off_peak)):
+			return False
+		with self._condition:
+			self._push(job_id, run_at)
+			self._condition.notify()
+		return True
+
+	def _pop_due(self, now: float) -> List[str]:
+		due = []
+		while self._heap and len(due) < self.batch_size:
+			run_at, job_id = self._heap[0]
+			if self._scheduled.get(job_id) != run_at:
+				heapq.heappop(self._heap)  # cancelled or rescheduled
+				continue
+			if run_at > now:
+				break
+			heapq.heappop(self._heap)
+			del self._scheduled[job_id]
+			due.append(job_id)
+		return due
+
+	def _loop(self):
+		while True:
+			with self._condition:
+				if self._stopped:
+					return
+				now = datetime.now(timezone.utc).timestamp()
+				if now >= self._horizon:
+					self._resync(now)
+				due = self._pop_due(now)
+				if not due:
+					next_run_at = self._heap[0][0] if self._heap else self._horizon
+					self._condition.wait(max(0.0, min(next_run_at, self._horizon) - now))
+					continue
+
+			try:
+				self._run_due(due, now)
+			except Exception:
+				logger.exception("Scheduled batch failed")
+
+	def _run_due(self, job_ids: List[str], now: float):
+		claimed = self.store.claim_due(job_ids, now, self.owner, now + self.lease_seconds)
+
+		# Jobs sharing actions (and a run id, when resuming after a crash) run as one batch
+		batches = {}
+		for row in claimed:
+			batches.setdefault((row['actions'], row['run_id']), []).append(row)
+
+		for (actions_json, run_id), rows in batches.items():
+			run_id = run_id or str(uuid.uuid4())
+			self.store.set_run_id([row['id'] for row in rows], run_id)
+			emails = [row['user_email'] for row in rows]
+			logger.info(f"Running scheduled batch {run_id} for {len(emails)} users")
+
+			try:
+				outcomes = self.runner(emails, json.loads(actions_json), run_id)
+			except Exception as e:
+				logger.exception(f"Scheduled batch {run_id} failed")
+				for row in rows:
+					self.store.finish(row['id'], self.owner, 'failed', {'error': str(e)})
+				continue
+
+			# A user scheduled more than once runs once; every one of their jobs gets that outcome
+			outcomes_by_email = {user_email.lower(): outcome for user_email, outcome in outcomes.items()}
+			for row in rows:
+				results = outcomes_by_email.get(row['user_email'].lower(), {}).get('results', [])
+				completed = any(result['action'] == 'Complete' for result in results)
+				errors = [result['message'] for result in results if result['status'] == 'error']
+				self.store.finish(row['id'], self.owner, 'done' if completed else 'failed', {'errors': errors})
@@ -0,0 +1,176 @@
+# directory_reconciliation.py - Cross-directory reconciliation between AD and Entra ID
+import time
+import logging
+from collections import Counter
+from typing import Dict, Iterator, Optional, Tuple
+import requests
+from config import Config
+from user_deprovisioning_service import UAC_ACCOUNTDISABLE, normalize_dn, split_dn
+
+
+logger = logging.getLogger(__name__)
+
+
+GRAPH_USERS_URL = 'https://graph.microsoft.com/v1.0/users'
+GRAPH_RECONCILE_SELECT = 'id,mail,userPrincipalName,accountEnabled,onPremisesSyncEnabled'
+GRAPH_PAGE_SIZE = 999  # maximum $top for /users
+
+# Suggested fix for each mismatch type; types without an entry are reported only
+MISMATCH_FIXES = {
+	'enabled_in_m365_disabled_in_ad': ['disableM365', 'revokeSessions'],
+	'enabled_in_m365_terminated_in_ad': ['disableM365', 'revokeSessions'],
+	'enabled_in_ad_disabled_in_m365': ['disableAD', 'expireAD']
+}
+
+# Which directory each fix acts on, and so which identity it is queued under:
+# Graph resolves users by UPN (or id), the AD lookup by mail or UPN
+MISMATCH_FIX_SIDES = {
+	'enabled_in_m365_disabled_in_ad': 'm365',
+	'enabled_in_m365_terminated_in_ad': 'm365',
+	'enabled_in_ad_disabled_in_m365': 'ad'
+}
+
+
+def iter_ad_users(connection, search_base: Optional[str] = None, page_size: Optional[int] = None) -> Iterator[Dict]:
+	"""Yield every AD user with a mail or UPN as a compact dict, one page at a time"""
+	entries = connection.extend.standard.paged_search(
+		search_base or Config.AD_SEARCH_BASE,
+		'(&(objectCategory=person)(objectClass=user)(|(mail=*)(userPrincipalName=*)))',
+		attributes=['mail', 'userPrincipalName', 'userAccountControl'],
+		paged_size=page_size or Config.AD_PAGE_SIZE,
+		generator=True
+	)
+
+	for entry in entries:
+		if entry.get('type') != 'searchResEntry':
+			continue
+
+		attributes = entry['attributes']
+		yield {
+			'dn': entry['dn'],
+			'mail': attributes.get('mail') or None,
+			'userPrincipalName': attributes.get('userPrincipalName') or None,
+			'enabled': not int(attributes.get('userAccountControl') or 0) & UAC_ACCOUNTDISABLE
+		}
+
+
+def iter_graph_users(access_token: str, max_retries: int = 5) -> Iterator[Dict]:
+	"""Yield every Entra ID user, following @odata.nextLink and honouring throttling"""
+	session = requests.Session()
+	session.headers.update({'Authorization': f'Bearer {access_token}'})
+
+	url = GRAPH_USERS_URL
+	params = {'$select': GRAPH_RECONCILE_SELECT, '$top': GRAPH_PAGE_SIZE}
+	retries = 0
+
+	while url:
+		response = session.get(url, params=params)
+		if response.status_code in (429, 503, 504) and retries < max_retries:
+			retries += 1
+			delay = float(response.headers.get('Retry-After', 2 ** retries))
+			logger.warning(f"Graph throttled the user listing, retrying in {delay}s")
+			time.sleep(delay)
+			continue
+		response.raise_for_status()
+		retries = 0
+
+		page = response.json()
+		yield from page.get('value', [])
+
+		# nextLink already carries the query string
+		url = page.get('@odata.nextLink')
+		params = None
+
+
+def _join_keys(user: Dict) -> Tuple[str, ...]:
+	return tuple(value.lower() for value in (user.get('mail'), user.get('userPrincipalName')) if value)
+
+
+def reconcile(ad_users: Iterator[Dict], graph_users: Iterator[Dict],
+			  terminated_ou: Optional[str] = None) -> Iterator[Dict]:
+	"""Hash-join AD and Entra ID users on mail/UPN and yield mismatches.
+
+	The AD side is materialised as the hash table (a small tuple per user);
+	Graph users are streamed against it and never held in memory. AD users
+	left unmatched at the end are reported as missing from M365. A final
+	record of type 'summary' carries counts per mismatch type.
+	"""
+	terminated_ou = normalize_dn(terminated_ou or Config.AD_TERMINATED_OU)
+
+	# key -> (dn, enabled, AD lookup name); each AD user is indexed under both its mail and UPN
+	ad_index: Dict[str, Tuple[str, bool, str]] = {}
+	for ad_user in ad_users:
+		ad_lookup = ad_user['mail'] or ad_user['userPrincipalName']
+		for key in _join_keys(ad_user):
+			ad_index.setdefault(key, (ad_user['dn'], ad_user['enabled'], ad_lookup))
+
+	counts = Counter()
+	matched_dns = set()
+
+	for graph_user in graph_users:
+		counts['m365_users'] += 1
+		keys = _join_keys(graph_user)
+		match = next((ad_index[key] for key in keys if key in ad_index), None)
+		email = graph_user.get('mail') or graph_user.get('userPrincipalName')
+
+		if match is None:
+			# Cloud-only accounts are expected to have no AD object
+			if graph_user.get('onPremisesSyncEnabled'):
+				counts['orphaned_in_m365'] += 1
+				yield _mismatch('orphaned_in_m365', email, graph_user=graph_user)
+			else:
+				counts['cloud_only'] += 1
+			continue
+
+		dn, ad_enabled, ad_lookup = match
+		matched_dns.add(dn)
+		m365_enabled = bool(graph_user.get('accountEnabled'))
+
+		mismatch_type = None
+		if m365_enabled and not ad_enabled:
+			mismatch_type = 'enabled_in_m365_disabled_in_ad'
+		elif m365_enabled and normalize_dn(split_dn(dn)[1]) == terminated_ou:
+			mismatch_type = 'enabled_in_m365_terminated_in_ad'
+		elif ad_enabled and not m365_enabled:
+			mismatch_type = 'enabled_in_ad_disabled_in_m365'
+
+		if mismatch_type:
+			counts[mismatch_type] += 1
+			yield _mismatch(mismatch_type, email, dn=dn, ad_enabled=ad_enabled, ad_lookup=ad_lookup,
+							graph_user=graph_user)
+
+	# Whatever the Graph stream never matched exists only in AD
+	reported = set()
+	for dn, ad_enabled, ad_lookup in ad_index.values():
+		if dn in matched_dns or dn in reported:
+			continue
+		reported.add(dn)
+		if ad_enabled:
+			counts['missing_in_m365'] += 1
+			yield _mismatch('missing_in_m365', ad_lookup, dn=dn, ad_enabled=ad_enabled, ad_lookup=ad_lookup)
+
+	counts['ad_users'] = len(matched_dns) + len(reported)
+	yield {'type': 'summary', **counts}
+
+
+def _mismatch(mismatch_type: str, email: Optional[str], dn: Optional[str] = None, ad_enabled: Optional[bool] = None,
+			  ad_lookup: Optional[str] = None, graph_user: Optional[Dict] = None) -> Dict:
+	side = MISMATCH_FIX_SIDES.get(mismatch_type)
+	if side == 'm365':
+		fix_target = graph_user.get('userPrincipalName') or graph_user.get('id')
+	elif side == 'ad':
+		fix_target = ad_lookup
+	else:
+		fix_target = None
+
+	return {
+		'type': 'mismatch',
+		'mismatch': mismatch_type,
+		'email': email,
+		'dn': dn,
+		'adEnabled': ad_enabled,
+		'm365Id': graph_user.get('id') if graph_user else None,
+		'm365Enabled': graph_user.get('accountEnabled') if graph_user else None,
+		'fix': MISMATCH_FIXES.get(mismatch_type, []),
+		'fixTarget': fix_target
+	}
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 import os
+import json
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
@@ -8,7 +13,7 @@ IGNORED_DIRS = {
 	"venv", ".venv", "__pycache__", ".git", ".hg", ".svn", ".idea", ".vscode",
 	"node_modules", ".mypy_cache", ".pytest_cache", ".ruff_cache", ".tox",
 	"dist", "build", "target", ".terraform", ".coverage",
-	"decom", "flask_session"   # <-- explicitly excluded
+	"decom", "flask_session", "journal"   # <-- explicitly excluded
 }
 
 
@@ -23,8 +28,15 @@ IGNORED_EXTS = {
 
 
 OUTPUT_FILE = "project_dump.txt"   # written in the current directory
+MANIFEST_FILE = ".project_dump.manifest.json"   # used by --incremental
 SCRIPT_FILE = "dump.py"        	# skip this file
 MAX_FILE_SIZE_MB = 2.0         	# skip files larger than this
+BINARY_SAMPLE_BYTES = 8192
+
+
+# Bytes that count as text; bytes.translate deletes them in C so the rest can be counted
+TEXT_CHARS = bytes({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x7F)))
+SECTION_END = "\n\n" + ("-" * 80) + "\n\n"
 
 
 
@@ -33,111 +45,207 @@ def looks_binary(sample: bytes) -> bool:
 	"""Heuristic: detect if file looks binary from a sample chunk."""
 	if b"\x00" in sample:
 		return True
-	textchars = bytearray({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x7F)))
 	if not sample:
 		return False
-	nontext = sum(b not in textchars for b in sample)
+	nontext = len(sample.translate(None, TEXT_CHARS))
 	return (nontext / len(sample)) > 0.30
 
 
 
 
+def read_file(fpath: Path) -> dict:
+	"""Read a file once: binary check, hash and the rendered text all come from the same bytes."""
+	try:
+		data = fpath.read_bytes()
+	except Exception as e:
+		return {"binary": False, "hash": None, "content": f"<<Could not read file: {e}>>"}
+
+	if looks_binary(data[:BINARY_SAMPLE_BYTES]):
+		return {"binary": True, "hash": None, "content": None}
+
+	try:
+		content = data.decode("utf-8")
+	except UnicodeDecodeError:
+		content = data.decode("latin-1")
+	return {"binary": False, "hash": hashlib.blake2b(data, digest_size=16).hexdigest(), "content": content}
+
+
+
+
+def load_manifest(manifest_path: Path, output_path: Path) -> dict:
+	"""Load the previous run's manifest, or nothing if it no longer matches the dump on disk."""
+	try:
+		manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+		if manifest.get("dump_size") == output_path.stat().st_size:
+			return manifest.get("files", {})
+	except (OSError, ValueError):
+		pass
+	return {}
+
+
+
+
+def collect_files(project_path: Path, skip_paths: set):
+	"""Walk the tree in sorted order, yielding (directory, [(relative path, path, stat) ...])."""
+	for root, dirs, files in os.walk(project_path, topdown=True, followlinks=False):
+		# Filter out ignored directories
+		dirs[:] = [d for d in dirs if d not in IGNORED_DIRS]
+		# Skip hidden dirs (except .github)
+		dirs[:] = sorted(d for d in dirs if not d.startswith(".") or d in {".github"})
+
+
+		rel_path = os.path.relpath(root, project_path)
+		rel_path = "" if rel_path == "." else rel_path
+
+
+		entries = []
+		skipped = 0
+		for fname in sorted(files):
+			fpath = Path(root) / fname
+
+
+			# Skip our own outputs, this script, and ignored extensions
+			if fpath in skip_paths or fpath.suffix.lower() in IGNORED_EXTS:
+				skipped += 1
+				continue
+
+
+			# Skip large files
+			try:
+				stat = fpath.stat()
+			except Exception:
+				skipped += 1
+				continue
+			if stat.st_size > MAX_FILE_SIZE_MB * 1024 * 1024:
+				skipped += 1
+				continue
+
+
+			entries.append((os.path.join(rel_path, fname) if rel_path else fname, fpath, stat))
+
+
+		yield rel_path, entries, skipped
+
+
+
+
 def main():
+	parser = argparse.ArgumentParser(description="Dump the project's text files into a single file")
+	parser.add_argument("--incremental", action="store_true",
+						help=f"only re-read files changed since the last run (tracked in {MANIFEST_FILE})")
+	parser.add_argument("--jobs", type=int, default=min(32, (os.cpu_count() or 1) * 4),
+						help="files read in parallel")
+	args = parser.parse_args()
+
+
 	project_path = Path.cwd()
 	output_path = project_path / OUTPUT_FILE
-	script_path = project_path / SCRIPT_FILE
+	manifest_path = project_path / MANIFEST_FILE
+	temp_path = project_path / (OUTPUT_FILE + ".tmp")
+	skip_paths = {output_path, manifest_path, temp_path, project_path / SCRIPT_FILE}
 
 
-	with open(output_path, "w", encoding="utf-8") as out:
-		files_written = 0
-		files_skipped = 0
-		dirs_seen = 0
+	previous = load_manifest(manifest_path, output_path) if args.incremental else {}
+	previous_dump = open(output_path, "rb") if previous else None
+	manifest = {}
+	files_written = 0
+	files_reused = 0
+	files_skipped = 0
+	dirs_seen = 0
 
 
-		for root, dirs, files in os.walk(project_path, topdown=True, followlinks=False):
-			# Filter out ignored directories
-			dirs[:] = [d for d in dirs if d not in IGNORED_DIRS]
-			# Skip hidden dirs (except .github)
-			dirs[:] = [d for d in dirs if not d.startswith(".") or d in {".github"}]
+	def section(rel_file: str, fpath: Path, stat) -> tuple:
+		"""Return (manifest entry, section bytes or None), reading the file only if it changed."""
+		entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+		old = previous.get(rel_file)
+		unchanged = old and old["size"] == stat.st_size and old["mtime_ns"] == stat.st_mtime_ns
+		if unchanged:
+			return {**old, **entry}, None
 
 
-			rel_path = os.path.relpath(root, project_path)
-			rel_path = "" if rel_path == "." else rel_path
+		result = read_file(fpath)
+		if result["binary"]:
+			return {**entry, "binary": True}, b""
+		if old and result["hash"] and old.get("hash") == result["hash"]:
+			# Touched but not modified: the previous section is still correct
+			return {**old, **entry}, None
 
 
-			# Write directory header
-			out.write(f"\n# Directory: {rel_path or project_path}\n")
-			out.write("=" * (len(rel_path or str(project_path)) + 12) + "\n\n")
-			dirs_seen += 1
+		body = f"## File: {rel_file}\n\n{result['content']}{SECTION_END}".encode("utf-8")
+		return {**entry, "hash": result["hash"]}, body
 
 
-			for fname in files:
-				fpath = Path(root) / fname
+	with ThreadPoolExecutor(max_workers=args.jobs) as executor, open(temp_path, "wb") as out:
+		# Results are consumed in submission order so the dump is stable; the
+		# window bounds how many file contents are held in memory at once
+		pending = deque()
 
 
-				# Skip the output file and this script itself
-				if fpath.resolve() in {output_path.resolve(), script_path.resolve()}:
-					files_skipped += 1
+		def drain(limit: int):
+			nonlocal files_written, files_reused, files_skipped
+			while len(pending) > limit:
+				kind, rel_file, future = pending.popleft()
+				if kind == "header":
+					out.write(rel_file)
 					continue
 
 
-				# Skip by extension
-				if fpath.suffix.lower() in IGNORED_EXTS:
+				entry, body = future.result()
+				if entry.get("binary"):
 					files_skipped += 1
+					manifest[rel_file] = entry
 					continue
 
 
-				# Skip large files
-				try:
-					if fpath.stat().st_size > MAX_FILE_SIZE_MB * 1024 * 1024:
-						files_skipped += 1
-						continue
-				except Exception:
-					files_skipped += 1
-					continue
+				offset = out.tell()
+				if body is None:
+					previous_dump.seek(entry["offset"])
+					body = previous_dump.read(entry["length"])
+					files_reused += 1
+				out.write(body)
+				manifest[rel_file] = {**entry, "offset": offset, "length": len(body)}
+				files_written += 1
 
 
-				# Binary check
-				try:
-					with open(fpath, "rb") as fb:
-						if looks_binary(fb.read(8192)):
-							files_skipped += 1
-							continue
-				except Exception:
-					files_skipped += 1
-					continue
+		for rel_path, entries, skipped in collect_files(project_path, skip_paths):
+			# Write directory header
+			header = f"\n# Directory: {rel_path or project_path}\n"
+			header += "=" * (len(rel_path or str(project_path)) + 12) + "\n\n"
+			pending.append(("header", header.encode("utf-8"), None))
+			dirs_seen += 1
+			files_skipped += skipped
 
 
-				# Read text content
-				try:
-					content = fpath.read_text(encoding="utf-8")
-				except UnicodeDecodeError:
-					try:
-						content = fpath.read_text(encoding="latin-1")
-					except Exception as e:
-						content = f"<<Could not read file (latin-1): {e}>>"
-				except Exception as e:
-					content = f"<<Could not read file: {e}>>"
+			for rel_file, fpath, stat in entries:
+				pending.append(("file", rel_file, executor.submit(section, rel_file, fpath, stat)))
+				drain(args.jobs * 4)
 
 
-				out.write(f"## File: {os.path.join(rel_path, fname) if rel_path else fname}\n\n")
-				out.write(content)
-				out.write("\n\n" + ("-" * 80) + "\n\n")
-				files_written += 1
+		drain(0)
 
 
 		# Write summary
-		out.write(f"\n# Summary\n")
-		out.write(f"Directories seen: {dirs_seen}\n")
-		out.write(f"Files written:	{files_written}\n")
-		out.write(f"Files skipped:	{files_skipped}\n")
+		out.write(f"\n# Summary\n".encode("utf-8"))
+		out.write(f"Directories seen: {dirs_seen}\n".encode("utf-8"))
+		out.write(f"Files written:	{files_written}\n".encode("utf-8"))
+		out.write(f"Files skipped:	{files_skipped}\n".encode("utf-8"))
 
 
-	print(f"Wrote {OUTPUT_FILE} in {project_path}")
+	if previous_dump:
+		previous_dump.close()
+
+
+	# Replace the dump atomically so an interrupted run never leaves a partial file
+	os.replace(temp_path, output_path)
+	if args.incremental:
+		manifest_path.write_text(json.dumps({"dump_size": output_path.stat().st_size, "files": manifest}), encoding="utf-8")
+
+
+	reused = f" ({files_reused} unchanged files reused)" if args.incremental else ""
+	print(f"Wrote {OUTPUT_FILE} in {project_path}{reused}")
 
 
 
 
 if __name__ == "__main__":
 	main()
-
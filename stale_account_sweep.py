@@ -0,0 +1,110 @@
+# stale_account_sweep.py - Stream AD for accounts that should be deprovisioned
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional
+from config import Config
+from user_deprovisioning_service import UAC_ACCOUNTDISABLE, ad_timestamp_to_datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+# Matching-rule OID for a bitwise AND on userAccountControl
+LDAP_MATCHING_RULE_BIT_AND = '1.2.840.113556.1.4.803'
+UAC_DONT_EXPIRE_PASSWORD = 0x10000
+
+SWEEP_ATTRIBUTES = [
+	'sAMAccountName', 'mail', 'userPrincipalName', 'lastLogonTimestamp',
+	'pwdLastSet', 'accountExpires', 'userAccountControl'
+]
+
+
+def to_ad_timestamp(moment: datetime) -> int:
+	"""Convert a datetime to an AD timestamp (100-nanosecond intervals since Jan 1, 1601 UTC)"""
+	return int((moment - datetime(1601, 1, 1, tzinfo=timezone.utc)).total_seconds() * 10000000)
+
+
+def build_stale_filter(inactive_days: int, password_age_days: Optional[int] = None,
+					   include_non_expiring: bool = False, now: Optional[datetime] = None) -> str:
+	"""Build an LDAP filter for enabled users that are inactive, never used, or past their expiry.
+
+	lastLogonTimestamp only replicates every 9-14 days, so inactive_days
+	should comfortably exceed that.
+	"""
+	now = now or datetime.now(timezone.utc)
+	logon_cutoff = to_ad_timestamp(now - timedelta(days=inactive_days))
+	password_cutoff = to_ad_timestamp(now - timedelta(days=password_age_days or inactive_days))
+
+	clauses = [
+		'(objectCategory=person)',
+		'(objectClass=user)',
+		f'(!(userAccountControl:{LDAP_MATCHING_RULE_BIT_AND}:={UAC_ACCOUNTDISABLE}))'
+	]
+	if not include_non_expiring:
+		# Accounts whose password never expires are usually service accounts
+		clauses.append(f'(!(userAccountControl:{LDAP_MATCHING_RULE_BIT_AND}:={UAC_DONT_EXPIRE_PASSWORD}))')
+
+	clauses.append(
+		'(|'
+		f'(&(lastLogonTimestamp<={logon_cutoff})(pwdLastSet<={password_cutoff}))'
+		f'(&(!(lastLogonTimestamp=*))(pwdLastSet<={password_cutoff}))'
+		f'(&(accountExpires>=1)(accountExpires<={to_ad_timestamp(now)}))'
+		')'
+	)
+	return f"(&{''.join(clauses)})"
+
+
+def _single_value(attributes: Dict, name: str):
+	value = attributes.get(name)
+	if isinstance(value, list):
+		return value[0] if value else None
+	return value
+
+
+def _isoformat(moment: Optional[datetime]) -> Optional[str]:
+	return moment.isoformat() if moment else None
+
+
+def iter_stale_accounts(connection, inactive_days: int, password_age_days: Optional[int] = None,
+						include_non_expiring: bool = False, search_base: Optional[str] = None,
+						page_size: Optional[int] = None) -> Iterator[Dict]:
+	"""Yield stale account candidates one at a time using a paged search.
+
+	Only one page of results is held in memory at once, so this is safe to run
+	against directories with hundreds of thousands of objects.
+	"""
+	now = datetime.now(timezone.utc)
+	search_filter = build_stale_filter(inactive_days, password_age_days, include_non_expiring, now)
+	entries = connection.extend.standard.paged_search(
+		search_base or Config.AD_SEARCH_BASE,
+		search_filter,
+		attributes=SWEEP_ATTRIBUTES,
+		paged_size=page_size or Config.AD_PAGE_SIZE,
+		generator=True
+	)
+
+	for entry in entries:
+		# Referrals and other non-entry responses carry no attributes
+		if entry.get('type') != 'searchResEntry':
+			continue
+
+		attributes = entry['attributes']
+		last_logon = ad_timestamp_to_datetime(_single_value(attributes, 'lastLogonTimestamp'))
+		expires = ad_timestamp_to_datetime(_single_value(attributes, 'accountExpires'))
+
+		if expires and expires <= now:
+			reason = 'expired'
+		elif last_logon is None:
+			reason = 'never_logged_on'
+		else:
+			reason = 'inactive'
+
+		yield {
+			'email': _single_value(attributes, 'mail') or _single_value(attributes, 'userPrincipalName'),
+			'sAMAccountName': _single_value(attributes, 'sAMAccountName'),
+			'dn': entry['dn'],
+			'reason': reason,
+			'lastLogon': _isoformat(last_logon),
+			'pwdLastSet': _isoformat(ad_timestamp_to_datetime(_single_value(attributes, 'pwdLastSet'))),
+			'accountExpires': _isoformat(expires)
+		}
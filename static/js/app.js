@@ -1,9 +1,62 @@
 // static/js/app.js - Updated with AD Credential Support
+const LOG_ROW_HEIGHT = 30;          // must match .log-entry height + margin in style.css
+const LOG_BUFFER_CAPACITY = 100000; // oldest entries are dropped beyond this
+const LOG_OVERSCAN_ROWS = 10;       // rows rendered above and below the viewport
+const ANIMATED_RESULTS_LIMIT = 20;  // larger result sets are logged without per-line delays
+
+// Fixed-capacity log store; entries keep a sequence number so filtered views survive eviction.
+// Sequence numbers keep increasing across clear() so rendered rows never match a new entry.
+class LogBuffer {
+    constructor(capacity) {
+        this.capacity = capacity;
+        this.nextSeq = 0;
+        this.clear();
+    }
+    
+    clear() {
+        this.entries = new Array(this.capacity);
+        this.start = 0;
+        this.length = 0;
+        this.firstSeq = this.nextSeq;
+        this.dropped = 0;
+    }
+    
+    push(entry) {
+        entry.seq = this.nextSeq++;
+        if (this.length < this.capacity) {
+            this.entries[(this.start + this.length) % this.capacity] = entry;
+            this.length++;
+        } else {
+            this.entries[this.start] = entry;
+            this.start = (this.start + 1) % this.capacity;
+            this.firstSeq++;
+            this.dropped++;
+        }
+        return entry;
+    }
+    
+    getBySeq(seq) {
+        if (seq < this.firstSeq || seq >= this.nextSeq) return null;
+        return this.entries[(this.start + seq - this.firstSeq) % this.capacity];
+    }
+    
+    forEach(callback) {
+        for (let i = 0; i < this.length; i++) {
+            callback(this.entries[(this.start + i) % this.capacity]);
+        }
+    }
+}
+
+
 class UserDeprovisioningApp {
     constructor() {
         this.isProcessing = false;
-        this.results = [];
+        this.logBuffer = new LogBuffer(LOG_BUFFER_CAPACITY);
+        this.logFilter = 'all';
+        this.visibleSeqs = [];      // sequence numbers matching the current filter, oldest first
+        this.renderScheduled = false;
         this.currentPassword = null;
+        this.pendingRun = null;
         this.init();
     }
     
@@ -27,6 +80,13 @@ class UserDeprovisioningApp {
         
         document.addEventListener('keydown', (e) => this.handleKeyboard(e));
         
+        const logContainer = document.getElementById('logContainer');
+        logContainer?.addEventListener('scroll', () => this.scheduleLogRender());
+        window.addEventListener('resize', () => this.scheduleLogRender());
+        
+        const logFilter = document.getElementById('logFilter');
+        logFilter?.addEventListener('change', () => this.setLogFilter(logFilter.value));
+        
         // Clear password field on page refresh for security
         if (adPassword) {
             adPassword.value = '';
@@ -115,27 +175,122 @@ class UserDeprovisioningApp {
     }
     
     addLogEntry(message, type = 'info', timestamp = null) {
+        const entry = this.logBuffer.push({
+            timestamp: timestamp || new Date().toLocaleTimeString(),
+            type: type,
+            message: message
+        });
+        
+        if (this.logFilter === 'all' || this.logFilter === type) {
+            this.visibleSeqs.push(entry.seq);
+        }
+        
+        this.scheduleLogRender();
+    }
+    
+    setLogFilter(filter) {
+        this.logFilter = filter;
+        this.visibleSeqs = [];
+        this.logBuffer.forEach(entry => {
+            if (filter === 'all' || entry.type === filter) {
+                this.visibleSeqs.push(entry.seq);
+            }
+        });
+        
+        const logContainer = document.getElementById('logContainer');
+        if (logContainer) {
+            logContainer.scrollTop = logContainer.scrollHeight;
+        }
+        this.scheduleLogRender();
+    }
+    
+    // Coalesce any number of appends into a single render per animation frame
+    scheduleLogRender() {
+        if (this.renderScheduled) return;
+        this.renderScheduled = true;
+        requestAnimationFrame(() => {
+            this.renderScheduled = false;
+            this.renderLog();
+        });
+    }
+    
+    renderLog() {
         const logContainer = document.getElementById('logContainer');
-        if (!logContainer) return;
+        const logSpacer = document.getElementById('logSpacer');
+        if (!logContainer || !logSpacer) return;
         
-        const entry = document.createElement('div');
-        const logTimestamp = timestamp || new Date().toLocaleTimeString();
+        // Forget filtered entries that have been evicted from the ring buffer
+        const firstSeq = this.logBuffer.firstSeq;
+        if (this.visibleSeqs.length && this.visibleSeqs[0] < firstSeq) {
+            let evicted = 0;
+            while (evicted < this.visibleSeqs.length && this.visibleSeqs[evicted] < firstSeq) evicted++;
+            this.visibleSeqs.splice(0, evicted);
+        }
         
-        entry.className = `log-entry log-${type}`;
-        entry.innerHTML = `
-            <span class="status-icon icon-${type}"></span>
-            <span class="timestamp">[${logTimestamp}]</span>
-            <span class="message">${this.escapeHtml(message)}</span>
-        `;
+        // Stay pinned to the bottom unless the user has scrolled up to read
+        const wasAtBottom = logContainer.scrollTop + logContainer.clientHeight >= logSpacer.offsetHeight - LOG_ROW_HEIGHT;
+        logSpacer.style.height = (this.visibleSeqs.length * LOG_ROW_HEIGHT) + 'px';
+        if (wasAtBottom) {
+            logContainer.scrollTop = logContainer.scrollHeight;
+        }
         
-        logContainer.appendChild(entry);
-        logContainer.scrollTop = logContainer.scrollHeight;
+        const first = Math.max(0, Math.floor(logContainer.scrollTop / LOG_ROW_HEIGHT) - LOG_OVERSCAN_ROWS);
+        const last = Math.min(
+            this.visibleSeqs.length,
+            Math.ceil((logContainer.scrollTop + logContainer.clientHeight) / LOG_ROW_HEIGHT) + LOG_OVERSCAN_ROWS
+        );
         
-        this.results.push({
-            timestamp: logTimestamp,
-            type: type,
-            message: message
+        // Reuse row elements so DOM size stays proportional to the viewport, not the log
+        const rows = logSpacer.children;
+        const needed = last - first;
+        while (rows.length < needed) {
+            logSpacer.appendChild(document.createElement('div'));
+        }
+        while (rows.length > needed) {
+            logSpacer.removeChild(logSpacer.lastChild);
+        }
+        
+        for (let i = 0; i < needed; i++) {
+            const entry = this.logBuffer.getBySeq(this.visibleSeqs[first + i]);
+            const row = rows[i];
+            row.style.top = ((first + i) * LOG_ROW_HEIGHT) + 'px';
+            if (row.dataset.seq === String(entry.seq)) continue;
+            
+            row.dataset.seq = entry.seq;
+            row.className = `log-entry log-${entry.type}`;
+            row.title = entry.message;
+            row.innerHTML = `
+                <span class="status-icon icon-${entry.type}"></span>
+                <span class="timestamp">[${entry.timestamp}]</span>
+                <span class="message">${this.escapeHtml(entry.message)}</span>
+            `;
+        }
+        
+        const logStats = document.getElementById('logStats');
+        if (logStats) {
+            const dropped = this.logBuffer.dropped;
+            logStats.textContent = `${this.visibleSeqs.length} shown` +
+                (dropped ? ` · ${dropped} oldest dropped` : '');
+        }
+    }
+    
+    downloadLog() {
+        const lines = [];
+        if (this.logBuffer.dropped) {
+            lines.push(`# ${this.logBuffer.dropped} oldest entries were dropped from the in-browser buffer`);
+        }
+        this.logBuffer.forEach(entry => {
+            lines.push(`[${entry.timestamp}] ${entry.type.toUpperCase()}: ${entry.message}`);
         });
+        
+        const blob = new Blob([lines.join('\n') + '\n'], { type: 'text/plain' });
+        const link = document.createElement('a');
+        link.href = URL.createObjectURL(blob);
+        link.download = `deprovisioning-log-${new Date().toISOString().replace(/[:.]/g, '-')}.txt`;
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
+        URL.revokeObjectURL(link.href);
     }
     
     escapeHtml(text) {
@@ -345,6 +500,14 @@ class UserDeprovisioningApp {
         this.addLogEntry(`🚨 DEPROVISIONING STARTED for: ${userEmail}`, 'warning');
         this.addLogEntry(`Using AD credentials: ${adCreds.username}`, 'info');
         
+        // Resume the previous run for this user if it did not finish
+        const isResume = this.pendingRun?.email === userEmail;
+        const runId = isResume ? this.pendingRun.runId : crypto.randomUUID();
+        this.pendingRun = { email: userEmail, runId: runId };
+        if (isResume) {
+            this.addLogEntry(`Resuming interrupted run ${runId}`, 'info');
+        }
+        
         try {
             const response = await fetch('/deprovision', {
                 method: 'POST',
@@ -353,7 +516,8 @@ class UserDeprovisioningApp {
                     userEmail: userEmail,
                     actions: actions,
                     adUsername: adCreds.username,
-                    adPassword: adCreds.password
+                    adPassword: adCreds.password,
+                    runId: runId
                 })
             });
             
@@ -366,6 +530,9 @@ class UserDeprovisioningApp {
             }
             
             if (response.ok && data.results) {
+                if (data.results.some(result => result.action === 'Complete')) {
+                    this.pendingRun = null;
+                }
                 await this.processResults(data.results, data.password);
             } else {
                 this.addLogEntry(`❌ Process failed: ${data.error}`, 'error');
@@ -375,6 +542,7 @@ class UserDeprovisioningApp {
         } catch (error) {
             this.addLogEntry(`❌ Network error: ${error.message}`, 'error');
             this.updateProgress(0, 'Error');
+            this.addLogEntry(`Run ${runId} can be resumed by starting again`, 'info');
         }
         
         setTimeout(() => {
@@ -393,11 +561,14 @@ class UserDeprovisioningApp {
     async processResults(results, password) {
         let successCount = 0;
         const totalCount = results.length;
+        const animate = totalCount <= ANIMATED_RESULTS_LIMIT;
         
         for (let i = 0; i < results.length; i++) {
             const result = results[i];
             
-            await this.sleep(300);
+            if (animate) {
+                await this.sleep(300);
+            }
             
             this.addLogEntry(result.message, result.status);
             
@@ -405,8 +576,14 @@ class UserDeprovisioningApp {
                 successCount++;
             }
             
-            const progress = ((i + 1) / totalCount) * 90;
-            this.updateProgress(progress, `Processing... ${i + 1}/${totalCount}`);
+            // Large result sets only touch the progress bar once per frame's worth of entries
+            if (animate || (i + 1) % 1000 === 0 || i === totalCount - 1) {
+                const progress = ((i + 1) / totalCount) * 90;
+                this.updateProgress(progress, `Processing... ${i + 1}/${totalCount}`);
+                if (!animate) {
+                    await this.nextFrame();
+                }
+            }
         }
         
         await this.sleep(500);
@@ -422,8 +599,8 @@ class UserDeprovisioningApp {
     }
     
     displayPassword(password) {
-        const logContainer = document.getElementById('logContainer');
-        if (!logContainer) return;
+        const passwordContainer = document.getElementById('passwordContainer');
+        if (!passwordContainer) return;
         
         const passwordDiv = document.createElement('div');
         passwordDiv.className = 'password-output';
@@ -443,8 +620,7 @@ class UserDeprovisioningApp {
             </button>
         `;
         
-        logContainer.appendChild(passwordDiv);
-        logContainer.scrollTop = logContainer.scrollHeight;
+        passwordContainer.appendChild(passwordDiv);
         
         this.currentPassword = password;
         this.addLogEntry('✅ Password generated and displayed above - copy immediately!', 'success');
@@ -485,11 +661,13 @@ class UserDeprovisioningApp {
     }
     
     clearLog() {
-        const logContainer = document.getElementById('logContainer');
-        if (!logContainer) return;
+        const passwordContainer = document.getElementById('passwordContainer');
+        if (passwordContainer) {
+            passwordContainer.innerHTML = '';
+        }
         
-        logContainer.innerHTML = '';
-        this.results = [];
+        this.logBuffer.clear();
+        this.visibleSeqs = [];
         this.currentPassword = null;
         
         this.updateProgress(0, 'Ready');
@@ -589,6 +767,10 @@ class UserDeprovisioningApp {
     async sleep(ms) {
         return new Promise(resolve => setTimeout(resolve, ms));
     }
+    
+    async nextFrame() {
+        return new Promise(resolve => requestAnimationFrame(resolve));
+    }
 }
 
 
@@ -620,6 +802,11 @@ function clearLog() {
 }
 
 
+function downloadLog() {
+    app?.downloadLog();
+}
+
+
 function closeConfirmation() {
     app?.closeConfirmation();
 }
@@ -2,17 +2,127 @@
 import secrets
 import string
 import logging
-from datetime import datetime, timedelta
-from typing import List, Dict, Optional
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Dict, Optional, Tuple
 import ldap3
-from ldap3 import Server, Connection, ALL, MODIFY_REPLACE, MODIFY_DELETE
+from ldap3 import Connection, BASE, RESTARTABLE, MODIFY_REPLACE, MODIFY_DELETE
+from ldap3.utils.dn import to_dn
+from ldap3.utils.conv import escape_filter_chars
 from config import Config
+from ad_server_pool import build_server_pool
 import requests
 
 
 logger = logging.getLogger(__name__)
 
 
+# userAccountControl flags
+UAC_ACCOUNTDISABLE = 0x0002
+UAC_NORMAL_ACCOUNT = 0x0200
+
+# accountExpires values meaning "never expires"
+AD_NEVER_EXPIRES = (0, 0x7FFFFFFFFFFFFFFF)
+
+GRAPH_USER_SELECT = 'id,displayName,givenName,surname,mail,userPrincipalName,accountEnabled,assignedLicenses,licenseAssignmentStates'
+GRAPH_LICENSE_SELECT = 'assignedLicenses,licenseAssignmentStates'
+
+# Action ids grouped by the category toggle they belong to in the UI
+ACTION_CATEGORIES = {
+	'adActions': ['disableAD', 'expireAD', 'resetADPassword'],
+	'm365Actions': ['disableM365', 'revokeSessions', 'reclaimLicenses'],
+	'mfaActions': ['removeMFA'],
+	'orgActions': ['moveToTerminated']
+}
+
+
+def ad_attribute(entry, name: str):
+	"""Return the first value of an attribute on an ldap3 entry, or None if it is not set"""
+	values = entry.entry_attributes_as_dict.get(name) or []
+	return values[0] if values else None
+
+
+def ad_timestamp_to_datetime(value) -> Optional[datetime]:
+	"""Convert an AD timestamp (raw or ldap3-formatted) to an aware UTC datetime, or None for never"""
+	if value is None:
+		return None
+	
+	if isinstance(value, datetime):
+		# ldap3 formats "never" as datetime.max and 0 as the 1601 epoch
+		if value.year >= 9999 or value.year <= 1601:
+			return None
+		return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+	
+	timestamp = int(value)
+	if timestamp in AD_NEVER_EXPIRES:
+		return None
+	return datetime(1601, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=timestamp // 10)
+
+
+def split_dn(dn: str):
+	"""Split a DN into its RDN and parent DN, honouring escaped commas"""
+	components = [component.strip() for component in to_dn(dn)]
+	return components[0], ','.join(components[1:])
+
+
+def build_actions(action_ids: List[str]) -> Dict:
+	"""Build the actions dict sent by the UI from a list of action ids"""
+	known = {action_id for ids in ACTION_CATEGORIES.values() for action_id in ids}
+	unknown = set(action_ids) - known
+	if unknown:
+		raise ValueError(f"Unknown actions: {', '.join(sorted(unknown))}")
+	
+	actions = {}
+	for category, ids in ACTION_CATEGORIES.items():
+		actions[category] = any(action_id in action_ids for action_id in ids)
+		for action_id in ids:
+			actions[action_id] = action_id in action_ids
+	return actions
+
+
+def summarize_reclaimed_skus(results: Iterable[Dict]) -> Dict[str, int]:
+	"""Count reclaimed licenses per SKU across a run's results"""
+	counts = Counter()
+	for result in results:
+		counts.update(result.get('details', {}).get('reclaimedSkus', []))
+	return dict(counts)
+
+
+def split_license_assignments(user: Dict) -> Tuple[List[str], List[str]]:
+	"""Split a Graph user's SKUs into directly assigned ones and ones inherited only from groups.
+
+	assignLicense cannot remove a group-inherited SKU, and including one fails
+	the whole call. A SKU assigned both ways is direct: removing the direct
+	assignment is allowed and the group keeps its own.
+	"""
+	states = user.get('licenseAssignmentStates')
+	if states is None:
+		return [license['skuId'] for license in user.get('assignedLicenses') or []], []
+	
+	direct = []
+	inherited = []
+	for state in states:
+		skus = inherited if state.get('assignedByGroup') else direct
+		if state['skuId'] not in skus:
+			skus.append(state['skuId'])
+	return direct, [sku_id for sku_id in inherited if sku_id not in direct]
+
+
+def ad_actions_needed(actions: Dict) -> bool:
+	"""Check whether the selected actions need an AD connection"""
+	return bool(actions.get('adActions') or actions.get('orgActions'))
+
+
+def m365_actions_needed(actions: Dict) -> bool:
+	"""Check whether the selected actions need the Microsoft Graph user"""
+	return bool(actions.get('m365Actions') or actions.get('mfaActions'))
+
+
+def normalize_dn(dn: str) -> str:
+	"""Normalize a DN for comparison"""
+	return ','.join(component.strip() for component in to_dn(dn)).lower()
+
+
 class UserDeprovisioningService:
 	def __init__(self):
 		self.ad_connection = None
@@ -20,17 +130,135 @@ class UserDeprovisioningService:
 		self.config = Config()
 		self.m365_username = None
 		self.m365_password = None
+		self.graph_client = None  # Graph access token, set by the caller when M365 actions run
+		self.journal = None
+		self.on_result = None  # optional callback invoked with each result as it is added
    	 
 	def add_result(self, action: str, status: str, message: str, details: Optional[Dict] = None):
 		"""Add a result to the results list"""
-		self.results.append({
+		result = {
 			'action': action,
 			'status': status,  # success, error, warning, info
 			'message': message,
 			'details': details or {},
 			'timestamp': datetime.now().isoformat()
-		})
+		}
+		self.results.append(result)
 		logger.info(f"{action} - {status}: {message}")
+		
+		if self.on_result:
+			self.on_result(result)
+	
+	def run_step(self, user_email: str, step: str, target_id: str, action, *args) -> bool:
+		"""Run a deprovisioning step, skipping it if the run journal shows it already completed"""
+		if self.journal and self.journal.is_completed(user_email, step):
+			self.add_result("Resume", "info", f"Skipping {step}: already completed in a previous attempt")
+			return True
+		
+		success = action(*args)
+		
+		if self.journal:
+			self.journal.record(user_email, step, target_id, 'success' if success else 'error')
+		return success
+	
+	def prepare_password(self, ad_user, graph_user) -> Optional[str]:
+		"""Generate the replacement password once lookups are done, or None if the user was not found"""
+		if not ad_user and not graph_user:
+			self.add_result("User Search", "error", "User not found in any connected system")
+			return None
+		
+		exclude_names = []
+		if graph_user:
+			exclude_names.extend([
+				graph_user.get('givenName', ''),
+				graph_user.get('surname', '')
+			])
+		elif ad_user:
+			exclude_names.extend([
+				str(getattr(ad_user, 'givenName', '')),
+				str(getattr(ad_user, 'sn', ''))
+			])
+		
+		password = self.generate_password(exclude_names=exclude_names)
+		self.add_result("Password", "success", "Secure password generated (excluding user names)")
+		return password
+	
+	def plan_steps(self, actions: Dict, ad_user, graph_user, password: str) -> List[tuple]:
+		"""Return the selected (step id, target id, action, args) tuples in execution order"""
+		steps = []
+		
+		# Active Directory actions
+		if actions.get('adActions') and ad_user:
+			user_dn = str(ad_user.distinguishedName)
+			
+			if actions.get('disableAD'):
+				steps.append(('disableAD', user_dn, self.disable_ad_account,
+							  (user_dn, ad_attribute(ad_user, 'userAccountControl'))))
+			
+			if actions.get('expireAD'):
+				steps.append(('expireAD', user_dn, self.set_ad_expiration,
+							  (user_dn, ad_attribute(ad_user, 'accountExpires'))))
+			
+			if actions.get('resetADPassword'):
+				steps.append(('resetADPassword', user_dn, self.reset_ad_password, (user_dn, password)))
+		
+		# Microsoft 365 actions
+		if actions.get('m365Actions') and graph_user:
+			user_id = graph_user['id']
+			
+			if actions.get('disableM365'):
+				steps.append(('disableM365', user_id, self.disable_m365_account,
+							  (user_id, graph_user.get('accountEnabled'))))
+			
+			if actions.get('revokeSessions'):
+				steps.append(('revokeSessions', user_id, self.revoke_m365_sessions, (user_id,)))
+			
+			if actions.get('reclaimLicenses'):
+				steps.append(('reclaimLicenses', user_id, self.remove_m365_licenses, (user_id, graph_user)))
+		
+		# MFA cleanup
+		if actions.get('mfaActions') and graph_user:
+			user_id = graph_user['id']
+			
+			if actions.get('removeMFA'):
+				steps.append(('removeMFA', user_id, self.remove_mfa_methods, (user_id,)))
+		
+		# Organizational actions
+		if actions.get('orgActions'):
+			if actions.get('moveToTerminated') and ad_user:
+				user_dn = str(ad_user.distinguishedName)
+				steps.append(('moveToTerminated', user_dn, self.move_ad_user, (user_dn,)))
+		
+		return steps
+	
+	def finish_user(self, user_email: str, actions: Dict, password: str) -> Optional[str]:
+		"""Record completion and return the password to hand back to the operator"""
+		if (actions.get('resetADPassword') and self.journal
+				and self.journal.was_completed_before(user_email, 'resetADPassword')):
+			# The password set by the earlier attempt is the one in effect
+			self.add_result("AD Password", "info", "AD password was already reset in a previous attempt of this run")
+			password = None
+		
+		self.add_result("Complete", "success", "User deprovisioning process completed successfully!")
+		return password
+	
+	def deprovision_user(self, user_email: str, actions: Dict) -> Optional[str]:
+		"""Look up a user and run the selected actions, returning the generated password"""
+		if self.journal and self.journal.is_resumed:
+			self.add_result("Resume", "info", f"Resuming run {self.journal.run_id}")
+		
+		# User lookup phase
+		ad_user = self.find_ad_user(user_email) if ad_actions_needed(actions) else None
+		graph_user = self.find_graph_user(user_email) if m365_actions_needed(actions) else None
+		
+		password = self.prepare_password(ad_user, graph_user)
+		if not password:
+			return None
+		
+		for step, target_id, action, args in self.plan_steps(actions, ad_user, graph_user, password):
+			self.run_step(user_email, step, target_id, action, *args)
+		
+		return self.finish_user(user_email, actions, password)
    	 
 	def generate_password(self, length: int = 16, exclude_names: Optional[List[str]] = None) -> str:
 		"""Generate a complex password excluding specified names"""
@@ -78,7 +306,7 @@ class UserDeprovisioningService:
 			}
 	   	 
 			url = f"https://graph.microsoft.com/v1.0/users/{email}"
-			response = requests.get(url, headers=headers)
+			response = requests.get(url, headers=headers, params={'$select': GRAPH_USER_SELECT})
 	   	 
 			if response.status_code == 200:
 				user = response.json()
@@ -98,8 +326,12 @@ class UserDeprovisioningService:
 			self.add_result("Graph User Search", "error", f"Graph user search exception: {str(e)}")
 			return None
 	
-	def disable_m365_account(self, user_id: str) -> bool:
+	def disable_m365_account(self, user_id: str, account_enabled: Optional[bool] = None) -> bool:
 		"""Disable Microsoft 365 account using OAuth token"""
+		if account_enabled is False:
+			self.add_result("M365 Disable", "info", "M365 account already disabled")
+			return True
+		
 		try:
 			headers = {
 				'Authorization': f'Bearer {self.graph_client}',
@@ -124,6 +356,74 @@ class UserDeprovisioningService:
 			self.add_result("M365 Disable", "error", f"M365 disable exception: {str(e)}")
 			return False
 	
+	def get_sku_part_numbers(self) -> Dict[str, str]:
+		"""Map the tenant's subscribed SKU ids to their part numbers (e.g. ENTERPRISEPACK)"""
+		try:
+			headers = {'Authorization': f'Bearer {self.graph_client}'}
+			response = requests.get("https://graph.microsoft.com/v1.0/subscribedSkus", headers=headers,
+									params={'$select': 'skuId,skuPartNumber'})
+			if response.status_code == 200:
+				return {sku['skuId']: sku['skuPartNumber'] for sku in response.json().get('value', [])}
+		except Exception as e:
+			logger.warning(f"Could not resolve SKU names: {e}")
+		return {}
+	
+	def report_license_assignments(self, direct_skus: List[str], group_skus: List[str], sku_names: Dict[str, str]):
+		"""Report SKUs left for group-based licensing to remove, or that the user has no licenses"""
+		if group_skus:
+			inherited = [sku_names.get(sku_id, sku_id) for sku_id in group_skus]
+			self.add_result("M365 Licenses", "info",
+							f"Left {len(group_skus)} group-assigned licenses; remove the user from the licensing groups: {', '.join(inherited)}",
+							{'groupAssignedSkus': inherited})
+		elif not direct_skus:
+			self.add_result("M365 Licenses", "info", "No licenses assigned")
+	
+	def remove_m365_licenses(self, user_id: str, licenses: Optional[Dict] = None) -> bool:
+		"""Remove the directly assigned licenses from a Microsoft 365 account.
+
+		licenses holds the user's assignedLicenses and licenseAssignmentStates; they are read if not given.
+		"""
+		try:
+			headers = {
+				'Authorization': f'Bearer {self.graph_client}',
+				'Content-Type': 'application/json'
+			}
+			
+			if licenses is None:
+				url = f"https://graph.microsoft.com/v1.0/users/{user_id}"
+				response = requests.get(url, headers=headers, params={'$select': GRAPH_LICENSE_SELECT})
+				if response.status_code != 200:
+					self.add_result("M365 Licenses", "error", f"Failed to read assigned licenses: {response.text}")
+					return False
+				licenses = response.json()
+			
+			sku_ids, group_skus = split_license_assignments(licenses)
+			if group_skus or not sku_ids:
+				self.report_license_assignments(sku_ids, group_skus, self.get_sku_part_numbers() if group_skus else {})
+			if not sku_ids:
+				return True
+			
+			data = {'addLicenses': [], 'removeLicenses': sku_ids}
+			url = f"https://graph.microsoft.com/v1.0/users/{user_id}/assignLicense"
+			response = requests.post(url, json=data, headers=headers)
+			
+			if response.status_code == 200:
+				sku_names = self.get_sku_part_numbers()
+				reclaimed = [sku_names.get(sku_id, sku_id) for sku_id in sku_ids]
+				self.add_result("M365 Licenses", "success", f"Reclaimed {len(sku_ids)} licenses: {', '.join(reclaimed)}",
+								{'reclaimedSkus': reclaimed})
+				return True
+			elif response.status_code == 403:
+				self.add_result("M365 Licenses", "error", "Insufficient permissions to remove licenses")
+				return False
+			else:
+				self.add_result("M365 Licenses", "error", f"Failed to remove licenses: {response.text}")
+				return False
+			
+		except Exception as e:
+			self.add_result("M365 Licenses", "error", f"License removal exception: {str(e)}")
+			return False
+	
 	def revoke_m365_sessions(self, user_id: str) -> bool:
 		"""Revoke all Microsoft 365 sessions using OAuth token"""
 		try:
@@ -207,12 +507,7 @@ class UserDeprovisioningService:
 	def connect_ad_with_credentials(self, username: str, password: str) -> bool:
 		"""Connect to Active Directory with user-provided credentials"""
 		try:
-			server = Server(
-				self.config.AD_SERVER,
-				get_info=ALL,
-				use_ssl=self.config.AD_USE_SSL,
-				port=self.config.AD_PORT
-			)
+			server_pool = build_server_pool(self.config)
 	   	 
 			# Try to format the username properly for AD
 			if '@' not in username:
@@ -223,17 +518,19 @@ class UserDeprovisioningService:
 			else:
 				formatted_username = username
 	   	 
+			# RESTARTABLE reopens the connection through the pool if a DC drops mid-run
 			self.ad_connection = Connection(
-				server,
+				server_pool,
 				formatted_username,
 				password,
-				auto_bind=True
+				auto_bind=True,
+				client_strategy=RESTARTABLE
 			)
 	   	 
 			self.add_result(
 				"AD Connection",
 				"success",
-				f"Successfully connected to Active Directory as: {formatted_username}"
+				f"Successfully connected to Active Directory ({self.ad_connection.server.host}) as: {formatted_username}"
 			)
 			return True
 	   	 
@@ -253,17 +550,22 @@ class UserDeprovisioningService:
 			return False
 	
 	def find_ad_user(self, email: str):
-		"""Find user in Active Directory by email"""
+		"""Find user in Active Directory by email, or by UPN for accounts without a mail attribute"""
 		try:
-			search_filter = f'(mail={email})'
+			value = escape_filter_chars(email)
+			search_filter = f'(&(objectClass=user)(|(mail={value})(userPrincipalName={value})))'
 			self.ad_connection.search(
 				self.config.AD_SEARCH_BASE,
 				search_filter,
-				attributes=['sAMAccountName', 'mail', 'givenName', 'sn', 'distinguishedName', 'userAccountControl']
+				attributes=['sAMAccountName', 'mail', 'userPrincipalName', 'givenName', 'sn', 'distinguishedName',
+							'userAccountControl', 'accountExpires']
 			)
 	   	 
 			if self.ad_connection.entries:
-				user = self.ad_connection.entries[0]
+				# If one user's mail is another's UPN, the mail match wins
+				entries = self.ad_connection.entries
+				user = next((entry for entry in entries
+							 if str(ad_attribute(entry, 'mail') or '').lower() == email.lower()), entries[0])
 				self.add_result("AD User Search", "success", f"Found AD user: {user.sAMAccountName}")
 				return user
 			else:
@@ -274,10 +576,27 @@ class UserDeprovisioningService:
 			self.add_result("AD User Search", "error", f"AD user search failed: {str(e)}")
 			return None
 	
-	def disable_ad_account(self, user_dn: str) -> bool:
-		"""Disable Active Directory account"""
+	def read_ad_attribute(self, user_dn: str, name: str):
+		"""Read the current value of a single attribute of an AD object"""
+		if not self.ad_connection.search(user_dn, '(objectClass=*)', search_scope=BASE, attributes=[name]):
+			return None
+		return ad_attribute(self.ad_connection.entries[0], name)
+	
+	def disable_ad_account(self, user_dn: str, current_uac: Optional[int] = None) -> bool:
+		"""Disable Active Directory account, preserving the other userAccountControl flags"""
 		try:
-			changes = {'userAccountControl': [(MODIFY_REPLACE, [514])]}  # 514 = disabled account
+			if current_uac is None:
+				current_uac = self.read_ad_attribute(user_dn, 'userAccountControl')
+			
+			if current_uac is None:
+				new_uac = UAC_NORMAL_ACCOUNT | UAC_ACCOUNTDISABLE
+			elif int(current_uac) & UAC_ACCOUNTDISABLE:
+				self.add_result("AD Disable", "info", "AD account already disabled")
+				return True
+			else:
+				new_uac = int(current_uac) | UAC_ACCOUNTDISABLE
+			
+			changes = {'userAccountControl': [(MODIFY_REPLACE, [new_uac])]}
 	   	 
 			if self.ad_connection.modify(user_dn, changes):
 				self.add_result("AD Disable", "success", "AD account disabled successfully")
@@ -290,9 +609,14 @@ class UserDeprovisioningService:
 			self.add_result("AD Disable", "error", f"AD disable exception: {str(e)}")
 			return False
 	
-	def set_ad_expiration(self, user_dn: str) -> bool:
+	def set_ad_expiration(self, user_dn: str, current_expires=None) -> bool:
 		"""Set AD account expiration to yesterday"""
 		try:
+			expires_at = ad_timestamp_to_datetime(current_expires)
+			if expires_at and expires_at <= datetime.now(timezone.utc):
+				self.add_result("AD Expiration", "info", "Account already expired")
+				return True
+			
 			yesterday = datetime.now() - timedelta(days=1)
 			# Convert to AD timestamp (100-nanosecond intervals since Jan 1, 1601)
 			ad_timestamp = str(int((yesterday - datetime(1601, 1, 1)).total_seconds() * 10000000))
@@ -332,7 +656,11 @@ class UserDeprovisioningService:
 		"""Move AD user to terminated OU"""
 		try:
 			# Extract CN from current DN
-			cn = user_dn.split(',')[0]  # Get the CN part
+			cn, parent_dn = split_dn(user_dn)
+			
+			if normalize_dn(parent_dn) == normalize_dn(self.config.AD_TERMINATED_OU):
+				self.add_result("AD Move", "info", "User already in terminated OU")
+				return True
 	   	 
 			if self.ad_connection.modify_dn(user_dn, cn, new_superior=self.config.AD_TERMINATED_OU):
 				self.add_result("AD Move", "success", f"User moved to terminated OU")